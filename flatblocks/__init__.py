@@ -0,0 +1,15 @@
+def get_block(*args, **kwargs):
+    """
+    Shortcut for ``flatblocks.api.get_block()``.
+    """
+    # Imported here, the models can't be loaded with the package
+    from flatblocks.api import get_block
+    return get_block(*args, **kwargs)
+
+
+def get_blocks(*args, **kwargs):
+    """
+    Shortcut for ``flatblocks.api.get_blocks()``.
+    """
+    from flatblocks.api import get_blocks
+    return get_blocks(*args, **kwargs)
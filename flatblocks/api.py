@@ -0,0 +1,495 @@
+"""
+Loading flatblocks from Python code.
+
+The template tags are thin wrappers around this module, so views, APIs or
+other template engines get the same caching, prefetching, autocreation and
+default handling by calling it directly::
+
+    from flatblocks.api import get_block, get_blocks, Defaults
+
+    flatblock = get_block('page.info', timeout=3600)
+    flatblocks = get_blocks(['promo.one', 'promo.two'], site=site,
+                            defaults=Defaults(content='Coming soon'))
+
+``get_block()`` returns a flatblock or ``None``, ``get_blocks()`` an
+ordered dictionary mapping the slugs to their flatblocks, fetched with one
+``get_many`` call and, for the misses, one ``slug__in`` query. Missing
+flatblocks are replaced by unsaved instances holding the default content if
+there is some, and left out otherwise. Flatblocks found in the cache are
+read-only ``CachedFlatBlock`` objects. ``timeout`` is the number of seconds
+the blocks are cached, ``None`` for ``FLATBLOCKS_CACHE_TIMEOUT`` and ``0`` to
+skip the cache.
+
+With ``FLATBLOCKS_BACKEND = 'snapshot'`` all the lookups are served from the
+snapshot file instead (see ``flatblocks.snapshot``).
+
+A ``BlockLoader`` remembers the cache generations and the flatblocks it has
+loaded, so that a sequence of lookups (e.g. all the tags of one rendering)
+hits the cache and the database as little as possible.
+"""
+
+import time
+
+from django.utils.datastructures import SortedDict
+
+from flatblocks import caching, metrics, settings
+from flatblocks.models import FlatBlock
+from flatblocks.prefetch import PrefetchedBlocks
+from flatblocks.sites import get_current_site
+from flatblocks.snapshot import get_snapshot
+from flatblocks.writebehind import write_queue
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Defaults(object):
+    """
+    The header and content used for missing flatblocks, for the creation of
+    static flatblocks and by the strict default check.
+    """
+    def __init__(self, header=None, content=None):
+        self.header = header
+        self.content = content
+
+    @property
+    def has_content(self):
+        return self.content is not None
+
+
+NO_DEFAULTS = Defaults()
+
+
+def has_defaults(defaults):
+    return defaults.has_content or defaults.header is not None
+
+
+def get_cache_timeout(timeout):
+    if timeout is None or timeout == 'None':
+        return settings.CACHE_TIMEOUT
+    return int(timeout)
+
+
+def default_block(slug, site, defaults):
+    """
+    Returns an unsaved flatblock standing in for a missing one, or ``None``
+    if there is no default content.
+    """
+    if not defaults.content:
+        return None
+    return FlatBlock(slug=slug, content=defaults.content,
+                     header=defaults.header, site=site)
+
+
+def count_cache_lookup(site_id, slug, value):
+    """
+    Reports the outcome of a cache lookup to the metrics.
+    """
+    if value is None:
+        metrics.incr('cache_miss', site_id, slug)
+    elif value == caching.MISSING:
+        metrics.incr('negative_hit', site_id, slug)
+    else:
+        metrics.incr('cache_hit', site_id, slug)
+
+
+def apply_strict_defaults(flatblock, defaults):
+    """
+    If the flatblock exists, but its fields are empty, and the
+    STRICT_DEFAULT_CHECK is True, then update the fields with the default
+    contents.
+    """
+    flatblock_updated = False
+    if not flatblock.header and defaults.header is not None:
+        flatblock.header = defaults.header
+        flatblock_updated = True
+    if not flatblock.content and defaults.has_content:
+        flatblock.content = defaults.content or flatblock.slug
+        flatblock_updated = True
+
+    if flatblock_updated and settings.STRICT_DEFAULT_CHECK_UPDATE:
+        metrics.incr('strict_default_update', flatblock.site_id,
+                     flatblock.slug)
+        if not settings.WRITE_BEHIND:
+            flatblock.save()
+        elif flatblock.pk is not None:
+            write_queue.update(flatblock)
+
+
+def create_flatblock(slug, site, defaults):
+    """
+    Creates a missing static flatblock with the given defaults. With
+    FLATBLOCKS_WRITE_BEHIND the new flatblock is returned unsaved and written
+    later on by the write queue.
+    """
+    metrics.incr('autocreate', site.pk, slug)
+    if settings.WRITE_BEHIND:
+        flatblock = FlatBlock(slug=slug, site=site,
+                              content=defaults.content or slug,
+                              header=defaults.header)
+        write_queue.create(flatblock)
+        return flatblock, True
+    return FlatBlock.objects.get_or_create(slug=slug, site=site, defaults={
+        'content': defaults.content or slug,
+        'header': defaults.header,
+    })
+
+
+def refresh_flatblock(cache_key, site_id, slug, timeout, autocreate,
+                      has_defaults):
+    """
+    Reloads a stale cache entry, usually in a thread of the refresh pool.
+    Entries that depend on the lookup (autocreation, strict default checks)
+    are removed instead, so that the next lookup recomputes them. Nothing is
+    cached if the block is changed while it is reloaded.
+    """
+    block = (site_id, slug)
+    version = caching.get_block_versions([block])[block]
+
+    def unchanged():
+        if caching.get_block_versions([block])[block] == version:
+            return True
+        logger.debug("%s changed while it was refreshed" % (slug,))
+        return False
+
+    try:
+        flatblock = FlatBlock.objects.get(slug=slug, site=site_id)
+    except FlatBlock.DoesNotExist:
+        if autocreate or not settings.NEGATIVE_CACHE_TIMEOUT:
+            caching.delete(cache_key)
+        elif unchanged():
+            caching.set_block(cache_key, caching.MISSING,
+                              min(timeout, settings.NEGATIVE_CACHE_TIMEOUT))
+        return
+    if has_defaults and settings.STRICT_DEFAULT_CHECK and \
+            (not flatblock.header or not flatblock.content):
+        caching.delete(cache_key)
+        return
+    if unchanged():
+        logger.debug("Refreshed %s" % (slug,))
+        caching.set_block(cache_key, flatblock, timeout)
+
+
+def load_bundle(site_id, generation, token, timeout):
+    """
+    Loads the records of all the flatblocks of a site with a single query
+    and caches them as its bundle, see ``caching.set_bundle()``.
+    """
+    records = dict((flatblock.slug, caching.encode_block(flatblock))
+                   for flatblock in FlatBlock.objects.filter(site=site_id))
+    return caching.set_bundle(site_id, generation, token, records, timeout)
+
+
+class BlockLoader(object):
+    """
+    Loads flatblocks through the cache and the database, remembering the
+    cache generations and the flatblocks loaded from the database.
+    """
+    def __init__(self):
+        self.prefetched = PrefetchedBlocks()
+        self.generations = {}
+        self.bundles = {}
+
+    def get_generation(self, site_id):
+        if site_id not in self.generations:
+            self.generations[site_id] = caching.get_generation(site_id)
+        return self.generations[site_id]
+
+    def get_block(self, slug, site=None, timeout=None, autocreate=False,
+                  defaults=None, group=None):
+        """
+        Returns the flatblock with the given slug, or ``None``. If
+        ``autocreate`` is true, a missing flatblock is created with the
+        given ``defaults``. ``group`` is the ``SlugGroup`` of static slugs
+        loaded together with this one.
+        """
+        if site is None:
+            site = get_current_site()
+        if defaults is None:
+            defaults = NO_DEFAULTS
+        if settings.BACKEND == 'snapshot':
+            return self.from_snapshot([slug], site, defaults).get(slug)
+        if settings.SITE_BUNDLE and timeout != 0:
+            found = self.from_bundle([slug], site,
+                                     autocreate and [slug] or (), defaults)
+            if slug in found:
+                if found[slug] == caching.MISSING:
+                    return default_block(slug, site, defaults)
+                return found[slug]
+        locked = False
+        try:
+            flatblock = None
+            if timeout != 0:
+                cache_key = caching.block_key(site.pk, slug,
+                                              self.get_generation(site.pk))
+                self.fetch_slug_group(group, site.pk)
+                flatblock = caching.get(cache_key)
+
+                # Only let one process at a time recompute a missing entry,
+                # the others wait for its result
+                if flatblock is None and settings.STAMPEDE_PROTECTION:
+                    locked = caching.acquire_lock(cache_key)
+                    if not locked:
+                        flatblock = caching.wait_for(cache_key)
+
+            if isinstance(flatblock, caching.StaleEntry):
+                if flatblock.is_stale():
+                    caching.refresh_pool.submit(cache_key, refresh_flatblock,
+                        cache_key, site.pk, slug, get_cache_timeout(timeout),
+                        autocreate, has_defaults(defaults))
+                flatblock = flatblock.value
+            flatblock = caching.decode_block(flatblock)
+            if timeout != 0:
+                count_cache_lookup(site.pk, slug, flatblock)
+
+            if flatblock == caching.MISSING:
+                # The block is known not to exist, and its absence is
+                # already cached
+                if not autocreate:
+                    return default_block(slug, site, defaults)
+                flatblock = None
+
+            if flatblock is None:
+                flatblock_created = False
+
+                if not autocreate:
+                    flatblock = self.load(slug, site, group)
+                else:
+                    try:
+                        flatblock = self.load(slug, site, group)
+                    except FlatBlock.DoesNotExist:
+                        flatblock, flatblock_created = create_flatblock(
+                            slug, site, defaults)
+                        if settings.PREFETCH_STATIC_BLOCKS:
+                            self.prefetched.add(flatblock)
+
+                if not flatblock_created and settings.STRICT_DEFAULT_CHECK:
+                    apply_strict_defaults(flatblock, defaults)
+
+                if timeout != 0:
+                    if timeout is None or timeout == 'None':
+                        logger.debug("Caching %s for the cache's default "
+                                     "timeout" % (slug,))
+                    else:
+                        logger.debug("Caching %s for %s seconds" % (slug,
+                            str(timeout)))
+                    caching.set_block(cache_key, flatblock,
+                                      get_cache_timeout(timeout))
+                else:
+                    logger.debug("Don't cache %s" % (slug,))
+            return flatblock
+        except FlatBlock.DoesNotExist:
+            if timeout != 0 and settings.NEGATIVE_CACHE_TIMEOUT:
+                logger.debug("Caching the absence of %s" % (slug,))
+                caching.set_block(cache_key, caching.MISSING, min(
+                    get_cache_timeout(timeout),
+                    settings.NEGATIVE_CACHE_TIMEOUT))
+            return default_block(slug, site, defaults)
+        finally:
+            if locked:
+                caching.release_lock(cache_key)
+
+    def get_blocks(self, slugs, site=None, timeout=None, autocreate=(),
+                   defaults=None):
+        """
+        Returns an ordered dictionary mapping the given slugs to their
+        flatblocks. ``autocreate`` is either a boolean or the collection of
+        slugs that may be created.
+        """
+        if site is None:
+            site = get_current_site()
+        if defaults is None:
+            defaults = NO_DEFAULTS
+        slugs = list(SortedDict.fromkeys(slugs))
+        if settings.BACKEND == 'snapshot':
+            return self.from_snapshot(slugs, site, defaults)
+        if autocreate is True:
+            autocreate = slugs
+        elif not autocreate:
+            autocreate = ()
+
+        found = {}
+        if settings.SITE_BUNDLE and timeout != 0:
+            found = self.from_bundle(slugs, site, autocreate, defaults)
+        rest = [slug for slug in slugs if slug not in found]
+
+        if timeout != 0 and rest:
+            generation = self.get_generation(site.pk)
+            keys = dict((caching.block_key(site.pk, slug, generation), slug)
+                        for slug in rest)
+            for key, value in caching.get_many(keys.keys()).items():
+                slug = keys[key]
+                if isinstance(value, caching.StaleEntry):
+                    if value.is_stale():
+                        caching.refresh_pool.submit(key, refresh_flatblock,
+                            key, site.pk, slug, get_cache_timeout(timeout),
+                            slug in autocreate, has_defaults(defaults))
+                    value = value.value
+                value = caching.decode_block(value)
+                if value == caching.MISSING and slug in autocreate:
+                    # Like get_block(), create blocks known not to exist
+                    continue
+                if value is not None:
+                    found[slug] = value
+            for slug in rest:
+                count_cache_lookup(site.pk, slug, found.get(slug))
+
+        missing = [slug for slug in rest if slug not in found]
+        if missing:
+            for slug in missing:
+                metrics.incr('db_lookup', site.pk, slug)
+            started = time.time()
+            loaded = dict((slug, caching.MISSING) for slug in missing)
+            if settings.PREFETCH_STATIC_BLOCKS:
+                self.prefetched.load(missing, site)
+                for slug in missing:
+                    loaded[slug] = self.prefetched.blocks[(site.pk, slug)] \
+                        or caching.MISSING
+            else:
+                for flatblock in FlatBlock.objects.filter(slug__in=missing,
+                                                          site=site):
+                    loaded[flatblock.slug] = flatblock
+            if metrics.is_enabled():
+                # Share the time of the query among the flatblocks
+                elapsed = (time.time() - started) / len(missing)
+                for slug in missing:
+                    metrics.timing('db_time', site.pk, slug, elapsed)
+
+            for slug, flatblock in loaded.items():
+                if flatblock == caching.MISSING:
+                    if slug in autocreate:
+                        loaded[slug], created = create_flatblock(
+                            slug, site, defaults)
+                elif settings.STRICT_DEFAULT_CHECK:
+                    apply_strict_defaults(flatblock, defaults)
+
+            if timeout != 0:
+                positive = dict((key, loaded[slug]) for key, slug
+                                in keys.items() if slug in loaded and
+                                loaded[slug] != caching.MISSING)
+                negative = dict((key, caching.MISSING) for key, slug
+                                in keys.items() if slug in loaded and
+                                loaded[slug] == caching.MISSING)
+                if positive:
+                    caching.set_blocks(positive, get_cache_timeout(timeout))
+                if negative and settings.NEGATIVE_CACHE_TIMEOUT:
+                    caching.set_blocks(negative, min(
+                        get_cache_timeout(timeout),
+                        settings.NEGATIVE_CACHE_TIMEOUT))
+            found.update(loaded)
+
+        flatblocks = SortedDict()
+        for slug in slugs:
+            flatblock = found[slug]
+            if flatblock == caching.MISSING:
+                flatblock = default_block(slug, site, defaults)
+            if flatblock is not None:
+                flatblocks[slug] = flatblock
+        return flatblocks
+
+    def from_snapshot(self, slugs, site, defaults):
+        """
+        Looks the flatblocks up in the snapshot of FLATBLOCKS_SNAPSHOT_PATH,
+        which is read-only: nothing is created or updated.
+        """
+        snapshot = get_snapshot()
+        flatblocks = SortedDict()
+        for slug in slugs:
+            flatblock = snapshot.get(site.pk, slug)
+            if flatblock is None:
+                flatblock = default_block(slug, site, defaults)
+            if flatblock is not None:
+                flatblocks[slug] = flatblock
+        return flatblocks
+
+    def get_bundle(self, site):
+        """
+        Returns the cached records of all the flatblocks of the site, keyed
+        by slug, loading them with a single query if needed. Returns
+        ``None`` if the bundle is too large to be cached.
+        """
+        if site.pk not in self.bundles:
+            generation = self.get_generation(site.pk)
+            records, token = caching.get_bundle(site.pk, generation)
+            if records is None:
+                records = load_bundle(site.pk, generation, token,
+                                      settings.CACHE_TIMEOUT)
+            if records == caching.TOO_LARGE:
+                records = None
+            self.bundles[site.pk] = records
+        return self.bundles[site.pk]
+
+    def from_bundle(self, slugs, site, autocreate, defaults):
+        """
+        Looks the flatblocks up in the bundle of their site. Returns a
+        dictionary mapping the slugs to their flatblocks or to ``MISSING``,
+        without the slugs the bundle can't answer: blocks that may be
+        created or need the strict default check.
+        """
+        records = self.get_bundle(site)
+        if records is None:
+            return {}
+        strict = settings.STRICT_DEFAULT_CHECK and has_defaults(defaults)
+        found = {}
+        for slug in slugs:
+            record = records.get(slug)
+            if record is None:
+                if slug not in autocreate:
+                    found[slug] = caching.MISSING
+                continue
+            flatblock = caching.decode_block(record)
+            if not strict or (flatblock.header and flatblock.content):
+                found[slug] = flatblock
+        for slug, flatblock in found.items():
+            count_cache_lookup(site.pk, slug, flatblock)
+        return found
+
+    def fetch_slug_group(self, group, site_id):
+        """
+        Within a request memo, loads the cache entries of all the static
+        flatblocks of a template with a single ``get_many`` call.
+        """
+        memo = caching.get_memo()
+        if memo is None or group is None or group in memo.groups:
+            return
+        memo.groups.add(group)
+        generation = self.get_generation(site_id)
+        caching.get_many([caching.block_key(site_id, slug, generation)
+                          for slug in group.slugs])
+
+    def load(self, slug, site, group=None):
+        """
+        Fetches the flatblock from the database, together with all the other
+        slugs of its group if prefetching is enabled.
+        """
+        metrics.incr('db_lookup', site.pk, slug)
+        if not metrics.is_enabled():
+            return self._load(slug, site, group)
+        started = time.time()
+        try:
+            return self._load(slug, site, group)
+        finally:
+            metrics.timing('db_time', site.pk, slug, time.time() - started)
+
+    def _load(self, slug, site, group):
+        if not settings.PREFETCH_STATIC_BLOCKS:
+            return FlatBlock.objects.get(slug=slug, site=site)
+        return self.prefetched.get(slug, site, group)
+
+
+def get_block(slug, site=None, timeout=None, autocreate=False, defaults=None):
+    """
+    Returns the flatblock with the given slug, or ``None``.
+    """
+    return BlockLoader().get_block(slug, site, timeout, autocreate, defaults)
+
+
+def get_blocks(slugs, site=None, timeout=None, autocreate=(), defaults=None):
+    """
+    Returns an ordered dictionary mapping the given slugs to their
+    flatblocks.
+    """
+    return BlockLoader().get_blocks(slugs, site, timeout, autocreate,
+                                    defaults)
@@ -0,0 +1,824 @@
+"""
+Cache access for flatblocks.
+
+All the cache traffic of the template tag goes through this module. It talks
+to Django's cache backend and, if ``FLATBLOCKS_LOCAL_CACHE`` is enabled,
+keeps a bounded in-process LRU copy of the hottest entries in front of it,
+so that most lookups don't need a network round trip nor unpickling.
+
+The local copies are dropped when they expire, or when another process
+changes a flatblock: every change stores a new token under a shared version
+key, which each process checks at most once every
+``FLATBLOCKS_LOCAL_CACHE_VERSION_CHECK`` seconds.
+
+Cache keys are namespaced by site id and by a generation, made of a global
+token and a per-site token. Replacing one of these tokens with
+``invalidate_site()`` or ``invalidate_all()`` makes every key of that site
+(or of the whole installation) unreachable at once; the orphaned entries
+simply expire.
+
+Slugs without a flatblock are cached too, as ``MISSING``, for at most
+``FLATBLOCKS_NEGATIVE_CACHE_TIMEOUT`` seconds. Creating the block replaces
+that marker like any other change.
+
+With ``FLATBLOCKS_STAMPEDE_PROTECTION`` only the process holding a short
+cache-backed lock recomputes a missing entry, while the others poll the cache
+for its result for up to ``FLATBLOCKS_STAMPEDE_WAIT`` seconds. To spread the
+expiry of entries written at the same time, timeouts are randomly varied by
+``FLATBLOCKS_CACHE_TIMEOUT_JITTER`` (a fraction of the timeout).
+
+Flatblocks aren't cached as model instances but as small versioned tuples
+(see ``encode_block()``), which are cheap to pickle and to load and are
+turned back into read-only ``CachedFlatBlock`` objects. Contents of at least
+``FLATBLOCKS_COMPRESS_THRESHOLD`` characters are stored zlib-compressed.
+
+With ``FLATBLOCKS_SITE_BUNDLE`` all the flatblocks of a site are cached
+together under ``bundle_key()``, stamped with the generation of the site
+and with a bundle token read before the flatblocks were loaded. Changing a
+flatblock replaces the token, so a bundle loaded before the change is stale
+even if it is only stored afterwards; so does a new generation.
+Sites whose bundle would exceed ``FLATBLOCKS_SITE_BUNDLE_MAX_BYTES`` get a
+``TOO_LARGE`` marker instead and keep using one key per flatblock.
+
+With ``FLATBLOCKS_STALE_WHILE_REVALIDATE`` flatblocks are cached as
+``StaleEntry`` instances, which are kept ``FLATBLOCKS_STALE_TIMEOUT`` seconds
+longer than the timeout of the tag. Once that timeout has passed the stale
+flatblock is still served, while ``refresh_pool`` reloads it in the
+background; only when the entry is gone the tag falls back to the database.
+
+Within ``request_memo()`` (or ``FlatBlockMemoMiddleware``) every value read
+from or written to the cache is also remembered until the block ends, so a
+block rendered several times costs a single lookup. Writes are deferred and
+sent with one ``set_many`` call per timeout when the block ends, unless a
+flatblock was changed in the meantime.
+
+With ``FLATBLOCKS_CACHE_RENDERED`` the template tag caches the rendered HTML
+of a block instead of the model instance. Such fragments are stored together
+with the version token of their block, which changes every time the block is
+saved or deleted, and are only used while both tokens match.
+"""
+
+import hashlib
+import random
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+from django.core.cache import cache
+from django.db import connection
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from flatblocks import settings
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Cached in place of a flatblock that doesn't exist
+MISSING = 'flatblocks:missing'
+# Version token of a request memo which hasn't read anything yet
+UNREAD = object()
+# Cached in place of a site bundle exceeding FLATBLOCKS_SITE_BUNDLE_MAX_BYTES
+TOO_LARGE = 'flatblocks:too-large'
+
+# This module defines a set() function mirroring the cache API
+_builtin_set = set
+
+# Version of the tuples flatblocks are cached as, see encode_block()
+PAYLOAD_VERSION = 1
+
+VERSION_KEY = settings.CACHE_PREFIX + 'version'
+GENERATION_KEY = settings.CACHE_PREFIX + 'generation'
+# Version tokens should outlive the entries they validate. 30 days is the
+# longest relative timeout memcached accepts.
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+class LocalCache(object):
+    """
+    A thread-safe LRU cache limited by the number of entries, by the
+    (pickled) size of the stored values and by the time entries are kept.
+    """
+    def __init__(self, max_entries, max_bytes, timeout):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now=None):
+        now = now or time.time()
+        with self._lock:
+            try:
+                expires, size, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires <= now:
+                self.size -= size
+                return None
+            # Re-insert the entry to mark it as the most recently used one
+            self._entries[key] = (expires, size, value)
+            return value
+
+    def set(self, key, value, timeout=None, now=None):
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        if timeout <= 0:
+            return
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            self.delete(key)
+            return
+        expires = (now or time.time()) + timeout
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (expires, size, value)
+            self.size += size
+            while len(self._entries) > self.max_entries or \
+                    self.size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class VersionedLocalCache(LocalCache):
+    """
+    A ``LocalCache`` which clears itself whenever the shared version token
+    in Django's cache changes. The token is checked at most once every
+    ``check_interval`` seconds, which bounds the time a process may serve
+    a flatblock changed by another process.
+    """
+    def __init__(self, max_entries, max_bytes, timeout, check_interval):
+        super(VersionedLocalCache, self).__init__(max_entries, max_bytes,
+                                                  timeout)
+        self.check_interval = check_interval
+        self.version = None
+        self.checked_at = 0
+
+    def check_version(self, now=None):
+        now = now or time.time()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        version = cache.get(VERSION_KEY)
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def get(self, key, now=None):
+        self.check_version(now)
+        return super(VersionedLocalCache, self).get(key, now)
+
+
+local_cache = VersionedLocalCache(
+    settings.LOCAL_CACHE_MAX_ENTRIES,
+    settings.LOCAL_CACHE_MAX_BYTES,
+    settings.LOCAL_CACHE_TIMEOUT,
+    settings.LOCAL_CACHE_VERSION_CHECK,
+)
+
+
+def jitter(timeout):
+    """
+    Varies ``timeout`` randomly by up to FLATBLOCKS_CACHE_TIMEOUT_JITTER.
+    """
+    if not settings.CACHE_TIMEOUT_JITTER or not timeout:
+        return timeout
+    spread = timeout * settings.CACHE_TIMEOUT_JITTER
+    return max(1, int(round(timeout + random.uniform(-spread, spread))))
+
+
+class RequestMemo(object):
+    """
+    The cache values read and written during one request. ``values`` maps
+    keys to their value, or to ``None`` for keys known to be missing,
+    ``pending`` holds the deferred writes by timeout and ``groups`` the slug
+    groups whose keys have already been fetched. ``version`` is the shared
+    version token, read together with the first values: if a flatblock was
+    changed since, the deferred writes may hold outdated values and are
+    dropped.
+    """
+    def __init__(self):
+        self.values = {}
+        self.pending = {}
+        self.groups = _builtin_set()
+        self.version = UNREAD
+
+    def fetch(self, keys):
+        """
+        Returns the values of ``keys`` found in the cache, reading the
+        version token along with the first of them.
+        """
+        if self.version is not UNREAD:
+            return _get_many(keys)
+        if settings.LOCAL_CACHE:
+            # The local cache reads the token at most once per check
+            # interval, and its entries are as recent as that token
+            local_cache.check_version()
+            self.version = local_cache.version
+            return _get_many(keys)
+        values = cache.get_many(list(keys) + [VERSION_KEY])
+        self.version = values.pop(VERSION_KEY, None)
+        return values
+
+    def changed(self):
+        """
+        Tells whether a flatblock was changed since the version token was
+        read. With FLATBLOCKS_LOCAL_CACHE only changes seen by the local
+        cache's version check are known.
+        """
+        if self.version is UNREAD:
+            return False
+        if settings.LOCAL_CACHE:
+            local_cache.check_version()
+            return local_cache.version != self.version
+        return cache.get(VERSION_KEY) != self.version
+
+    def flush(self):
+        if self.pending and self.changed():
+            logger.debug("Flatblocks changed during the request, dropping "
+                         "its cache writes")
+            self.pending.clear()
+            return
+        for timeout, data in self.pending.items():
+            timeout = jitter(timeout)
+            cache.set_many(data, timeout)
+            if settings.LOCAL_CACHE:
+                for key, value in data.items():
+                    local_cache.set(key, value, timeout)
+        self.pending.clear()
+
+
+_state = threading.local()
+
+
+def get_memo():
+    """
+    Returns the ``RequestMemo`` of the current thread or ``None``.
+    """
+    return getattr(_state, 'memo', None)
+
+
+def start_memo():
+    _state.memo = RequestMemo()
+    return _state.memo
+
+
+def end_memo():
+    memo = get_memo()
+    _state.memo = None
+    if memo is not None:
+        memo.flush()
+
+
+@contextmanager
+def request_memo():
+    """
+    Remembers the flatblock cache traffic within the ``with`` block, and
+    writes the new cache entries in bulk when it ends.
+    """
+    previous = get_memo()
+    memo = start_memo()
+    try:
+        yield memo
+    finally:
+        _state.memo = previous
+        memo.flush()
+
+
+def _get(key):
+    if not settings.LOCAL_CACHE:
+        return cache.get(key)
+    value = local_cache.get(key)
+    if value is None:
+        value = cache.get(key)
+        if value is not None:
+            local_cache.set(key, value)
+    return value
+
+
+def _get_many(keys):
+    if not settings.LOCAL_CACHE:
+        return cache.get_many(keys)
+    values = {}
+    missing = []
+    for key in keys:
+        value = local_cache.get(key)
+        if value is None:
+            missing.append(key)
+        else:
+            values[key] = value
+    if missing:
+        for key, value in cache.get_many(missing).items():
+            local_cache.set(key, value)
+            values[key] = value
+    return values
+
+
+def get(key):
+    """
+    Returns the value cached under ``key`` or ``None``.
+    """
+    memo = get_memo()
+    if memo is None:
+        return _get(key)
+    if key not in memo.values:
+        if memo.version is UNREAD:
+            memo.values[key] = memo.fetch([key]).get(key)
+        else:
+            memo.values[key] = _get(key)
+    return memo.values[key]
+
+
+def get_many(keys):
+    """
+    Returns a dict with the values of the given keys found in the cache.
+    """
+    memo = get_memo()
+    if memo is None:
+        return _get_many(keys)
+    missing = [key for key in keys if key not in memo.values]
+    if missing:
+        found = memo.fetch(missing)
+        for key in missing:
+            memo.values[key] = found.get(key)
+    return dict((key, memo.values[key]) for key in keys
+                if memo.values[key] is not None)
+
+
+def set(key, value, timeout):
+    memo = get_memo()
+    if memo is not None:
+        memo.values[key] = value
+        memo.pending.setdefault(timeout, {})[key] = value
+        return
+    timeout = jitter(timeout)
+    cache.set(key, value, timeout)
+    if settings.LOCAL_CACHE:
+        local_cache.set(key, value, timeout)
+
+
+def set_many(data, timeout):
+    memo = get_memo()
+    if memo is not None:
+        memo.values.update(data)
+        memo.pending.setdefault(timeout, {}).update(data)
+        return
+    timeout = jitter(timeout)
+    cache.set_many(data, timeout)
+    if settings.LOCAL_CACHE:
+        for key, value in data.items():
+            local_cache.set(key, value, timeout)
+
+
+def delete(key):
+    memo = get_memo()
+    if memo is not None:
+        memo.values.pop(key, None)
+        for data in memo.pending.values():
+            data.pop(key, None)
+    cache.delete(key)
+    if settings.LOCAL_CACHE:
+        local_cache.delete(key)
+
+
+class StaleEntry(object):
+    """
+    A cached flatblock (or ``MISSING``) which should be reloaded once
+    ``fresh_until`` has passed, but may be served until the entry expires.
+    """
+    def __init__(self, value, fresh_until):
+        self.value = value
+        self.fresh_until = fresh_until
+
+    def is_stale(self, now=None):
+        return (now or time.time()) >= self.fresh_until
+
+
+class CachedFlatBlock(object):
+    """
+    A read-only flatblock restored from the cache, with the attributes the
+    templates use.
+    """
+    __slots__ = ('pk', 'site_id', 'slug', 'header', 'content')
+
+    def __init__(self, pk, site_id, slug, header, content):
+        for name, value in zip(self.__slots__,
+                               (pk, site_id, slug, header, content)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Cached flatblocks are read-only")
+
+    @property
+    def id(self):
+        return self.pk
+
+    def __unicode__(self):
+        return u"%s" % (self.slug,)
+
+    def __repr__(self):
+        return '<CachedFlatBlock: %s>' % (self.slug,)
+
+
+def encode_block(flatblock):
+    """
+    Returns the tuple a flatblock is cached as. Its content is compressed if
+    it is at least ``FLATBLOCKS_COMPRESS_THRESHOLD`` characters long.
+    """
+    content = flatblock.content
+    compressed = False
+    threshold = settings.COMPRESS_THRESHOLD
+    if threshold is not None and content and len(content) >= threshold:
+        content = zlib.compress(content.encode('utf-8'))
+        compressed = True
+    return (PAYLOAD_VERSION, compressed, flatblock.pk, flatblock.site_id,
+            flatblock.slug, flatblock.header, content)
+
+
+def decode_block(value):
+    """
+    Turns a cached tuple back into a ``CachedFlatBlock``. Tuples of another
+    payload version are treated like a cache miss (``None``), anything else
+    (``MISSING``, ``None``) is returned as is.
+    """
+    if not isinstance(value, tuple):
+        return value
+    if value[0] != PAYLOAD_VERSION:
+        return None
+    version, compressed, pk, site_id, slug, header, content = value
+    if compressed:
+        content = zlib.decompress(content).decode('utf-8')
+    return CachedFlatBlock(pk, site_id, slug, header, content)
+
+
+def set_block(key, flatblock, timeout):
+    """
+    Caches a flatblock (or ``MISSING``) for the template tags, wrapped in
+    a ``StaleEntry`` in stale-while-revalidate mode.
+    """
+    set_blocks({key: flatblock}, timeout)
+
+
+def set_blocks(data, timeout):
+    data = dict((key, value == MISSING and MISSING or encode_block(value))
+                for key, value in data.items())
+    if settings.STALE_WHILE_REVALIDATE:
+        fresh_until = time.time() + timeout
+        data = dict((key, StaleEntry(value, fresh_until))
+                    for key, value in data.items())
+        timeout += settings.STALE_TIMEOUT
+    if len(data) == 1:
+        key, value = list(data.items())[0]
+        set(key, value, timeout)
+    else:
+        set_many(data, timeout)
+
+
+class RefreshPool(object):
+    """
+    A small pool of daemon threads reloading stale cache entries. Every key
+    is queued at most once at a time, and refreshes are dropped while the
+    queue is full: the stale entry is then simply served a little longer.
+    Without threads refreshes run right away in the calling thread.
+    """
+    def __init__(self, threads, max_queued):
+        self.threads = threads
+        self.queue = Queue(max_queued)
+        self.pending = _builtin_set()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def submit(self, key, func, *args):
+        with self._lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        if not self.threads:
+            self.run(key, func, args)
+            return True
+        self.start()
+        try:
+            self.queue.put_nowait((key, func, args))
+        except Full:
+            with self._lock:
+                self.pending.discard(key)
+            return False
+        return True
+
+    def start(self):
+        with self._lock:
+            while len(self._workers) < self.threads:
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def work(self):
+        while True:
+            key, func, args = self.queue.get()
+            try:
+                self.run(key, func, args)
+                # Don't keep a database connection per worker thread open
+                connection.close()
+            finally:
+                self.queue.task_done()
+
+    def run(self, key, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("Refreshing %s failed" % (key,))
+        finally:
+            with self._lock:
+                self.pending.discard(key)
+
+    def join(self):
+        """
+        Waits until all queued refreshes are done.
+        """
+        self.queue.join()
+
+
+refresh_pool = RefreshPool(settings.REFRESH_THREADS,
+                           settings.REFRESH_MAX_QUEUED)
+
+
+def lock_key(key):
+    return key + '_lock'
+
+
+def acquire_lock(key):
+    """
+    Tries to become the only process recomputing the entry of ``key``.
+    """
+    return cache.add(lock_key(key), 1, settings.STAMPEDE_LOCK_TIMEOUT)
+
+
+def release_lock(key):
+    """
+    Writes the recomputed entry of ``key`` right away, even within a request
+    memo, so that the waiting processes can use it, and releases the lock.
+    """
+    memo = get_memo()
+    if memo is not None:
+        for timeout, data in memo.pending.items():
+            if key in data:
+                value = data.pop(key)
+                cache.set(key, value, jitter(timeout))
+                if settings.LOCAL_CACHE:
+                    local_cache.set(key, value, timeout)
+    cache.delete(lock_key(key))
+
+
+def wait_for(key):
+    """
+    Polls the cache until another process has stored the entry of ``key``.
+    Returns ``None`` if it didn't happen within FLATBLOCKS_STAMPEDE_WAIT
+    seconds.
+    """
+    deadline = time.time() + settings.STAMPEDE_WAIT
+    while time.time() < deadline:
+        time.sleep(settings.STAMPEDE_POLL_INTERVAL)
+        value = cache.get(key)
+        if value is not None:
+            memo = get_memo()
+            if memo is not None:
+                memo.values[key] = value
+            return value
+    return None
+
+
+def bump_version():
+    """
+    Tells every process that its local copies are outdated.
+    """
+    version = uuid.uuid4().hex
+    cache.set(VERSION_KEY, version, VERSION_TIMEOUT)
+    local_cache.clear()
+    local_cache.version = version
+    memo = get_memo()
+    if memo is not None:
+        memo.values.clear()
+
+
+def site_generation_key(site_id):
+    return '%sgeneration_%s' % (settings.CACHE_PREFIX, site_id)
+
+
+def add_token(key):
+    """
+    Creates the missing token ``key``, unless another process just did, and
+    returns it. Like a value read, it is remembered for the rest of the
+    request.
+    """
+    cache.add(key, uuid.uuid4().hex, VERSION_TIMEOUT)
+    token = cache.get(key)
+    memo = get_memo()
+    if memo is not None:
+        memo.values[key] = token
+    if settings.LOCAL_CACHE and token is not None:
+        local_cache.set(key, token)
+    return token
+
+
+def get_generation(site_id):
+    """
+    Returns the current cache generation of the given site. Missing tokens
+    are (re)created, which invalidates everything cached with the old ones.
+    """
+    keys = [GENERATION_KEY, site_generation_key(site_id)]
+    tokens = get_many(keys)
+    for key in keys:
+        if key not in tokens:
+            tokens[key] = add_token(key)
+    return '%s.%s' % (tokens[keys[0]], tokens[keys[1]])
+
+
+def block_key(site_id, slug, generation):
+    return '%s%s_%s_%s' % (settings.CACHE_PREFIX, site_id, generation, slug)
+
+
+def invalidate_block(site_id, slug):
+    """
+    Removes everything cached for the given block.
+    """
+    delete(block_key(site_id, slug, get_generation(site_id)))
+    if settings.SITE_BUNDLE:
+        cache.set(bundle_token_key(site_id), uuid.uuid4().hex, VERSION_TIMEOUT)
+    bump_block_version(site_id, slug)
+    bump_version()
+
+
+def invalidate_site(site_id):
+    """
+    Invalidates everything cached for the flatblocks of the given site.
+    """
+    cache.set(site_generation_key(site_id), uuid.uuid4().hex,
+              VERSION_TIMEOUT)
+    bump_version()
+
+
+def invalidate_all():
+    """
+    Invalidates everything cached for the flatblocks of all sites.
+    """
+    cache.set(GENERATION_KEY, uuid.uuid4().hex, VERSION_TIMEOUT)
+    bump_version()
+
+
+def bundle_key(site_id):
+    return '%sbundle_%s' % (settings.CACHE_PREFIX, site_id)
+
+
+def bundle_token_key(site_id):
+    return '%sbundle_token_%s' % (settings.CACHE_PREFIX, site_id)
+
+
+def get_bundle(site_id, generation):
+    """
+    Returns the cached records of all the flatblocks of a site (or
+    ``TOO_LARGE``) and the current bundle token of the site. The records
+    are ``None`` if the bundle isn't cached or is stale. A missing token is
+    created.
+    """
+    keys = [bundle_key(site_id), bundle_token_key(site_id)]
+    values = get_many(keys)
+    token = values.get(keys[1])
+    if token is None:
+        token = add_token(keys[1])
+    value = values.get(keys[0])
+    if value is None or value[:2] != (generation, token):
+        return None, token
+    return value[2], token
+
+
+def set_bundle(site_id, generation, token, records, timeout):
+    """
+    Caches the records of all the flatblocks of a site, stamped with the
+    generation and the bundle token read before they were loaded. Bundles
+    larger than ``FLATBLOCKS_SITE_BUNDLE_MAX_BYTES`` are replaced by
+    ``TOO_LARGE``, so that the site falls back to one entry per flatblock.
+    Returns what was cached.
+    """
+    size = len(pickle.dumps(records, pickle.HIGHEST_PROTOCOL))
+    if size > settings.SITE_BUNDLE_MAX_BYTES:
+        logger.warning("The flatblocks of site %s take %d bytes, caching "
+                       "them one by one" % (site_id, size))
+        records = TOO_LARGE
+    set(bundle_key(site_id), (generation, token, records), timeout)
+    return records
+
+
+def block_version_key(site_id, slug):
+    return '%sv_%s_%s' % (settings.CACHE_PREFIX, site_id, slug)
+
+
+def bump_block_version(site_id, slug):
+    """
+    Invalidates all the rendered fragments of the given block.
+    """
+    cache.set(block_version_key(site_id, slug), uuid.uuid4().hex,
+              VERSION_TIMEOUT)
+
+
+def fragment_key(site_id, slug, generation, template_name, vary_on=(),
+                 only=False):
+    """
+    Returns the key of a rendered fragment. ``vary_on`` holds the values of
+    the context variables the wrapper template depends on, ``only`` tells
+    whether it was rendered with the flatblock alone in its context.
+    """
+    parts = [site_id, slug, generation, template_name, only]
+    parts.extend(vary_on)
+    digest = hashlib.md5(u'|'.join(
+        [unicode(part) for part in parts]).encode('utf-8')).hexdigest()
+    return '%sfragment_%s' % (settings.CACHE_PREFIX, digest)
+
+
+def get_block_versions(blocks):
+    """
+    Returns the version tokens of the given ``(site_id, slug)`` pairs,
+    creating the missing ones. They have to be read before the blocks are
+    loaded: fragments of blocks changed in the meantime are then stored
+    with the old token, and never used.
+    """
+    keys = [block_version_key(site_id, slug) for site_id, slug in blocks]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, uuid.uuid4().hex, VERSION_TIMEOUT)
+        versions.update(cache.get_many(missing))
+    return dict((block, versions.get(key))
+                for block, key in zip(blocks, keys))
+
+
+def get_fragment(key, site_id, slug):
+    """
+    Returns the rendered fragment stored under ``key``, or ``None`` if there
+    is none or its block has changed since it was rendered, and the current
+    version token of the block, to be passed to ``set_fragment()``.
+    """
+    version_key = block_version_key(site_id, slug)
+    values = get_many([version_key, key])
+    version = values.get(version_key)
+    if version is None:
+        return None, add_token(version_key)
+    entry = values.get(key)
+    if entry is None or entry[0] != version:
+        return None, version
+    return entry[1], version
+
+
+def set_fragment(key, version, output, timeout):
+    """
+    Stores a rendered fragment with the version token its block had before
+    it was loaded, as returned by ``get_fragment()``.
+    """
+    if version is not None:
+        set(key, (version, output), timeout)
+
+
+def set_fragments(fragments, timeout):
+    """
+    Stores many rendered fragments at once. ``fragments`` is a list of
+    ``(key, version, output)`` tuples, see ``get_block_versions()``.
+    """
+    data = dict((key, (version, output))
+                for key, version, output in fragments if version is not None)
+    if data:
+        set_many(data, timeout)
@@ -0,0 +1,19 @@
+from django.contrib.sites.models import Site
+from django.core.management import CommandError
+
+
+def get_sites(values):
+    """
+    Returns the sites given by id or domain in the ``--site`` options of a
+    command.
+    """
+    sites = []
+    for value in values:
+        try:
+            if value.isdigit():
+                sites.append(Site.objects.get(pk=value))
+            else:
+                sites.append(Site.objects.get(domain=value))
+        except Site.DoesNotExist:
+            raise CommandError("Unknown site: %s" % value)
+    return sites
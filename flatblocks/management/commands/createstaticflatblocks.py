@@ -0,0 +1,177 @@
+import os
+from optparse import make_option
+
+from django.conf import settings as django_settings
+from django.contrib.sites.models import Site
+from django.core.management import BaseCommand
+from django.template import Context, Template, TemplateDoesNotExist, \
+    TemplateSyntaxError
+
+from flatblocks import caching
+from flatblocks.management import get_sites
+from flatblocks.models import FlatBlock
+from flatblocks.templatetags.flatblock_tags import FlatBlockNode, \
+    FlatBlocksNode
+
+
+FILESYSTEM_LOADER = 'django.template.loaders.filesystem.Loader'
+APP_DIRECTORIES_LOADER = 'django.template.loaders.app_directories.Loader'
+CACHED_LOADER = 'django.template.loaders.cached.Loader'
+
+
+def get_template_dirs(loaders=None):
+    """
+    Returns the directories searched by the filesystem and app directories
+    template loaders among ``loaders`` (TEMPLATE_LOADERS by default), also
+    when they are wrapped by the cached loader. Templates served by other
+    loaders can't be listed and are ignored.
+    """
+    if loaders is None:
+        loaders = django_settings.TEMPLATE_LOADERS
+    dirs = []
+    for loader in loaders:
+        if isinstance(loader, (tuple, list)):
+            loader, args = loader[0], loader[1:]
+        else:
+            args = ()
+        if loader == FILESYSTEM_LOADER:
+            found = django_settings.TEMPLATE_DIRS
+        elif loader == APP_DIRECTORIES_LOADER:
+            from django.template.loaders.app_directories import \
+                app_template_dirs
+            found = app_template_dirs
+        elif loader == CACHED_LOADER and args:
+            found = get_template_dirs(args[0])
+        else:
+            found = ()
+        for template_dir in found:
+            if template_dir not in dirs:
+                dirs.append(template_dir)
+    return dirs
+
+
+def iter_template_files(template_dirs):
+    for template_dir in template_dirs:
+        for root, dirnames, filenames in os.walk(template_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(root, filename)
+
+
+def get_static_blocks(source, errors=None):
+    """
+    Compiles the template source and returns a list of ``(slug, header,
+    content)`` tuples for the flatblocks it refers to by a hard-coded slug,
+    the same way render-time autocreation would create them. ``with-default``
+    content is rendered with an empty context, a header given as a variable
+    is left empty. Blocks whose default content can't be rendered that way
+    are left out, and ``(slug, exception)`` tuples appended to ``errors``.
+    """
+    if 'flatblock' not in source:
+        return []
+    if errors is None:
+        errors = []
+    blocks = []
+    nodelist = Template(source).nodelist
+    for node in nodelist.get_nodes_by_type(FlatBlockNode):
+        if node.is_variable:
+            continue
+        header = node.default_header
+        if node.default_header_is_variable:
+            header = None
+        content = None
+        if node.default_content:
+            try:
+                content = node.default_content.render(Context())
+            except Exception, e:
+                errors.append((node.slug, e))
+                continue
+        blocks.append((node.slug, header, content or node.slug))
+    for node in nodelist.get_nodes_by_type(FlatBlocksNode):
+        slugs = [slug for slug, is_variable in node.slugs if not is_variable]
+        header = node.default_header
+        if not isinstance(header, basestring):
+            header = None
+        content = None
+        if node.default_content and slugs:
+            try:
+                content = node.default_content.render(Context())
+            except Exception, e:
+                errors.extend((slug, e) for slug in slugs)
+                continue
+        for slug in slugs:
+            blocks.append((slug, header, content or slug))
+    return blocks
+
+
+class Command(BaseCommand):
+    help = "Create the flatblocks used by name in the templates"
+    args = "[template_dir template_dir ...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--site', action='append', dest='sites', default=[],
+            help='Create the flatblocks for the site with this id or domain '
+                 '(use multiple --site for several sites). Defaults to the '
+                 'current site.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Only list the flatblocks that would be '
+                                'created.'),
+    )
+
+    def get_sites(self, sites):
+        if not sites:
+            return [Site.objects.get_current()]
+        return get_sites(sites)
+
+    def collect(self, template_dirs, verbosity=1):
+        """
+        Returns the static flatblocks of all the templates in the given
+        directories, as a dictionary mapping the slugs to their defaults.
+        """
+        found = {}
+        for path in iter_template_files(template_dirs):
+            errors = []
+            try:
+                with open(path) as f:
+                    source = f.read().decode(django_settings.FILE_CHARSET)
+                blocks = get_static_blocks(source, errors)
+            except (UnicodeDecodeError, TemplateSyntaxError,
+                    TemplateDoesNotExist), e:
+                if verbosity > 1:
+                    self.stderr.write("Skipping %s: %s\n" % (path, e))
+                continue
+            if verbosity > 0:
+                for slug, e in errors:
+                    self.stderr.write("Skipping %s in %s: %s\n" % (
+                        slug, path, e))
+            for slug, header, content in blocks:
+                # The first template giving default content wins
+                if slug not in found or \
+                        (found[slug][1] == slug and content != slug):
+                    found[slug] = (header, content)
+        return found
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        sites = self.get_sites(options['sites'])
+        template_dirs = list(args) or get_template_dirs()
+        found = self.collect(template_dirs, verbosity)
+
+        for site in sites:
+            existing = set(FlatBlock.objects.filter(site=site,
+                slug__in=found.keys()).values_list('slug', flat=True))
+            missing = [FlatBlock(slug=slug, header=header, content=content,
+                                 site=site)
+                       for slug, (header, content) in sorted(found.items())
+                       if slug not in existing]
+            if verbosity > 1 or options['dry_run']:
+                for flatblock in missing:
+                    self.stdout.write("%s: %s\n" % (site.domain,
+                                                    flatblock.slug))
+            if not options['dry_run'] and missing:
+                FlatBlock.objects.bulk_create(missing)
+                # bulk_create() sends no signals, drop cached absences
+                caching.invalidate_site(site.pk)
+            if verbosity > 0:
+                self.stdout.write("%s %d of %d flatblocks for %s\n" % (
+                    options['dry_run'] and "Would create" or "Created",
+                    len(missing), len(found), site.domain))
@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management import BaseCommand, CommandError
+
+from flatblocks import settings
+from flatblocks.management import get_sites
+from flatblocks.models import FlatBlock
+from flatblocks.snapshot import export_snapshot
+
+
+class Command(BaseCommand):
+    help = "Export the flatblocks to a snapshot file"
+    args = "[path]"
+    option_list = BaseCommand.option_list + (
+        make_option('--site', action='append', dest='sites', default=[],
+            help='Only export the flatblocks of the site with this id or '
+                 'domain (use multiple --site for several sites).'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("This command takes at most one path")
+        path = args and args[0] or settings.SNAPSHOT_PATH
+        if not path:
+            raise CommandError("Pass the path of the snapshot file or set "
+                               "FLATBLOCKS_SNAPSHOT_PATH")
+        flatblocks = FlatBlock.objects.all()
+        if options['sites']:
+            flatblocks = flatblocks.filter(site__in=get_sites(
+                options['sites']))
+        count = export_snapshot(path, flatblocks)
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Exported %d flatblocks to %s\n" % (count, path))
@@ -0,0 +1,175 @@
+import fnmatch
+import time
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+from django.template import Context, loader
+
+from flatblocks import caching, settings
+from flatblocks.api import load_bundle
+from flatblocks.management import get_sites
+from flatblocks.models import FlatBlock
+
+
+def warm_chunk(rows, timeout, template_names):
+    """
+    Caches the flatblocks of the given ``(pk, site_id, slug)`` rows the way
+    the template tags do, and optionally their fragments rendered with the
+    given wrapper templates. Returns the number of blocks and fragments
+    written.
+    """
+    generations = {}
+    blocks = {}
+    fragments = []
+    templates = [(name, loader.get_template(name)) for name in template_names]
+    versions = {}
+    if templates:
+        versions = caching.get_block_versions(
+            [(site_id, slug) for pk, site_id, slug in rows])
+    for flatblock in FlatBlock.objects.filter(
+            pk__in=[row[0] for row in rows]):
+        site_id = flatblock.site_id
+        if site_id not in generations:
+            generations[site_id] = caching.get_generation(site_id)
+        generation = generations[site_id]
+        blocks[caching.block_key(site_id, flatblock.slug, generation)] = \
+            flatblock
+        for name, tmpl in templates:
+            key = caching.fragment_key(site_id, flatblock.slug, generation,
+                                       name)
+            output = tmpl.render(Context({'flatblock': flatblock}))
+            fragments.append((key, versions.get((site_id, flatblock.slug)),
+                              output))
+    if blocks:
+        caching.set_blocks(blocks, timeout)
+    if fragments:
+        caching.set_fragments(fragments, timeout)
+    return len(blocks), len(fragments)
+
+
+def warm_bundle(site_id, timeout):
+    """
+    Caches the bundle of all the flatblocks of the given site, see
+    FLATBLOCKS_SITE_BUNDLE. Returns whether it was small enough to be
+    cached.
+    """
+    generation = caching.get_generation(site_id)
+    token = caching.get_bundle(site_id, generation)[1]
+    return load_bundle(site_id, generation, token, timeout) != \
+        caching.TOO_LARGE
+
+
+def _warm_chunk(args):
+    return warm_chunk(*args)
+
+
+def _init_worker():
+    # Don't share the parent's database connection with the workers
+    connection.close()
+
+
+class Command(BaseCommand):
+    help = "Populate the cache with flatblocks"
+    option_list = BaseCommand.option_list + (
+        make_option('--site', action='append', dest='sites', default=[],
+            help='Only warm the flatblocks of the site with this id or '
+                 'domain (use multiple --site for several sites).'),
+        make_option('--slug', dest='slug', default=None,
+            help='Only warm the flatblocks whose slug matches this '
+                 'shell-style pattern, e.g. "sidebar.*".'),
+        make_option('--timeout', dest='timeout', type='int', default=None,
+            help='Cache timeout in seconds. Defaults to '
+                 'FLATBLOCKS_CACHE_TIMEOUT.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=500, help='Number of flatblocks written per set_many '
+                              'call.'),
+        make_option('--render', action='append', dest='templates',
+            default=[], help='Also cache the fragments rendered with this '
+                             'wrapper template (use multiple --render for '
+                             'several templates).'),
+        make_option('--processes', dest='processes', type='int', default=1,
+            help='Number of processes warming chunks in parallel.'),
+    )
+
+    def get_queryset(self, sites, slug):
+        queryset = FlatBlock.objects.all()
+        if sites:
+            queryset = queryset.filter(site__in=get_sites(sites))
+        if slug:
+            # Narrow down the query with the literal prefix of the pattern,
+            # the pattern itself is matched below
+            prefix = slug
+            for wildcard in '*?[':
+                prefix = prefix.split(wildcard)[0]
+            if prefix:
+                queryset = queryset.filter(slug__startswith=prefix)
+        return queryset.order_by('pk')
+
+    def iter_chunks(self, queryset, slug, chunk_size):
+        """
+        Yields the ``(pk, site_id, slug)`` rows of the flatblocks to warm in
+        lists of at most ``chunk_size``. Chunks are read by primary key
+        ranges, so that no cursor stays open while the previous chunk is
+        being cached.
+        """
+        last_pk = None
+        while True:
+            rows = queryset
+            if last_pk is not None:
+                rows = rows.filter(pk__gt=last_pk)
+            rows = list(rows.values_list('pk', 'site', 'slug')[
+                :chunk_size].iterator())
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            chunk = [row for row in rows if not slug or
+                     fnmatch.fnmatchcase(row[2], slug)]
+            if chunk:
+                yield chunk
+
+    def handle(self, *args, **options):
+        timeout = options['timeout']
+        if timeout is None:
+            timeout = settings.CACHE_TIMEOUT
+        templates = options['templates']
+        for name in templates:
+            if settings.CACHE_RENDERED_VARY_ON.get(name):
+                raise CommandError("The fragments of %s depend on the "
+                                   "context and can't be pre-rendered" % name)
+        queryset = self.get_queryset(options['sites'], options['slug'])
+        chunks = self.iter_chunks(queryset, options['slug'],
+                                  options['chunk_size'])
+        jobs = ((chunk, timeout, templates) for chunk in chunks)
+
+        started = time.time()
+        if options['processes'] > 1:
+            connection.close()
+            pool = Pool(options['processes'], _init_worker)
+            try:
+                results = list(pool.imap_unordered(_warm_chunk, jobs))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [warm_chunk(*job) for job in jobs]
+        elapsed = max(time.time() - started, 0.001)
+
+        blocks = sum(result[0] for result in results)
+        fragments = sum(result[1] for result in results)
+        self.stdout.write("Cached %d flatblocks and %d fragments in %.2fs "
+                          "(%d flatblocks/s)\n" % (
+                          blocks, fragments, elapsed, blocks / elapsed))
+
+        if settings.SITE_BUNDLE:
+            # A bundle holds all the flatblocks of its site, whatever the
+            # slug pattern
+            if options['sites']:
+                site_ids = [site.pk for site in get_sites(options['sites'])]
+            else:
+                site_ids = FlatBlock.objects.order_by().values_list(
+                    'site', flat=True).distinct()
+            bundles = len([site_id for site_id in site_ids
+                           if warm_bundle(site_id, timeout)])
+            self.stdout.write("Cached the bundles of %d sites\n" % bundles)
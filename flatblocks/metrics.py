@@ -0,0 +1,203 @@
+"""
+Metrics about flatblock lookups.
+
+With ``FLATBLOCKS_METRICS`` enabled, the lookups report the following
+events, by site and slug, to the sinks listed in ``FLATBLOCKS_METRICS_SINKS``:
+
+    ``cache_hit``, ``cache_miss``, ``negative_hit``
+        A lookup found the flatblock in the cache, nothing, or the cached
+        absence of the flatblock.
+    ``db_lookup``, ``db_time``
+        A flatblock was fetched from the database (or from the blocks
+        prefetched from it in the same rendering), and the time it took.
+    ``autocreate``, ``strict_default_update``
+        A static flatblock was created, or the defaults of a tag were stored
+        in an existing one.
+    ``render``
+        The time spent rendering the wrapper template of a flatblock tag.
+
+A sink is any object with ``incr(name, site_id, slug, value)`` and
+``timing(name, site_id, slug, seconds)`` methods. The default
+``AggregateSink`` keeps counters and timing histograms in process, and
+``snapshot()`` returns their current values, e.g. for the ``metrics`` view.
+
+Objects with the same methods can also be registered as listeners of the
+current thread with ``add_listener()``. They get the events of that thread
+whether ``FLATBLOCKS_METRICS`` is enabled or not; the ``flatblocks.profiler``
+uses this.
+"""
+
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from flatblocks import settings
+
+
+# Upper bounds of the buckets of the timing histograms, in milliseconds
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, milliseconds):
+        self.count += 1
+        self.total += milliseconds
+        if self.min is None or milliseconds < self.min:
+            self.min = milliseconds
+        if self.max is None or milliseconds > self.max:
+            self.max = milliseconds
+        for index, bound in enumerate(BUCKETS):
+            if milliseconds <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.buckets[index] += 1
+
+    def as_dict(self):
+        buckets = dict(('le_%s' % bound, count) for bound, count
+                       in zip(BUCKETS, self.buckets))
+        buckets['inf'] = self.buckets[-1]
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'buckets': buckets,
+        }
+
+
+class AggregateSink(object):
+    """
+    Keeps the counters and timing histograms in process.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, site_id, slug, value=1):
+        key = (name, site_id, slug)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, site_id, slug, seconds):
+        key = (name, site_id, slug)
+        with self._lock:
+            histogram = self.timings.get(key)
+            if histogram is None:
+                histogram = self.timings[key] = Histogram()
+            histogram.add(seconds * 1000)
+
+    def snapshot(self):
+        """
+        Returns the current values as a list of dictionaries, one per
+        metric, site and slug.
+        """
+        with self._lock:
+            records = [{'name': name, 'site': site_id, 'slug': slug,
+                        'value': value}
+                       for (name, site_id, slug), value
+                       in self.counters.items()]
+            for (name, site_id, slug), histogram in self.timings.items():
+                record = histogram.as_dict()
+                record.update({'name': name, 'site': site_id, 'slug': slug})
+                records.append(record)
+        records.sort(key=lambda record: (record['name'], record['site'],
+                                         record['slug']))
+        return records
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+
+
+_sinks = None
+_local = threading.local()
+
+
+def get_sinks():
+    """
+    Returns the sink instances configured in FLATBLOCKS_METRICS_SINKS.
+    """
+    global _sinks
+    if _sinks is None or _sinks[0] != settings.METRICS_SINKS:
+        sinks = []
+        for path in settings.METRICS_SINKS:
+            module, attr = path.rsplit('.', 1)
+            try:
+                sinks.append(getattr(import_module(module), attr)())
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured("Error loading flatblocks metrics "
+                                           "sink %s: %s" % (path, e))
+        _sinks = (settings.METRICS_SINKS, sinks)
+    return _sinks[1]
+
+
+def add_listener(listener):
+    """
+    Sends the events of the current thread to ``listener`` as well.
+    """
+    listeners = getattr(_local, 'listeners', None)
+    if listeners is None:
+        listeners = _local.listeners = []
+    listeners.append(listener)
+
+
+def remove_listener(listener):
+    getattr(_local, 'listeners', []).remove(listener)
+
+
+def has_listeners():
+    return bool(getattr(_local, 'listeners', None))
+
+
+def incr(name, site_id, slug, value=1):
+    for listener in getattr(_local, 'listeners', ()):
+        listener.incr(name, site_id, slug, value)
+    if not settings.METRICS:
+        return
+    for sink in get_sinks():
+        sink.incr(name, site_id, slug, value)
+
+
+def timing(name, site_id, slug, seconds):
+    for listener in getattr(_local, 'listeners', ()):
+        listener.timing(name, site_id, slug, seconds)
+    if not settings.METRICS:
+        return
+    for sink in get_sinks():
+        sink.timing(name, site_id, slug, seconds)
+
+
+def is_enabled():
+    """
+    Whether the events of the current thread are recorded at all.
+    """
+    return settings.METRICS or has_listeners()
+
+
+def snapshot():
+    """
+    Returns the values of all the sinks that keep them, see
+    ``AggregateSink.snapshot()``.
+    """
+    records = []
+    for sink in get_sinks():
+        if hasattr(sink, 'snapshot'):
+            records.extend(sink.snapshot())
+    return records
+
+
+def reset():
+    for sink in get_sinks():
+        if hasattr(sink, 'reset'):
+            sink.reset()
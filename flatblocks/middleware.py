@@ -0,0 +1,47 @@
+from flatblocks import caching, profiler, settings
+from flatblocks.writebehind import write_queue
+
+
+class FlatBlockMemoMiddleware(object):
+    """
+    Remembers the flatblock cache lookups made while handling a request, so
+    that every cache entry is read at most once per request, and writes the
+    new entries with one ``set_many`` call once the response is ready.
+    """
+    def process_request(self, request):
+        caching.start_memo()
+
+    def process_response(self, request, response):
+        caching.end_memo()
+        return response
+
+
+class FlatBlockWriteBehindMiddleware(object):
+    """
+    Writes the flatblocks created or updated by the template tags while
+    handling a request once the response is ready, if
+    FLATBLOCKS_WRITE_BEHIND is enabled without a background thread.
+    """
+    def process_response(self, request, response):
+        if settings.WRITE_BEHIND and not write_queue.interval and \
+                len(write_queue):
+            write_queue.flush()
+        return response
+
+
+class FlatBlockProfilerMiddleware(object):
+    """
+    Profiles the flatblock lookups of every request, warns about repeated
+    or too many database lookups and reports the time spent in a
+    ``Server-Timing`` header. Meant for development and testing, see
+    ``flatblocks.profiler``.
+    """
+    def process_request(self, request):
+        profiler.start_profile(settings.PROFILER_MAX_DB_LOOKUPS)
+
+    def process_response(self, request, response):
+        profile = profiler.end_profile()
+        if profile is not None:
+            profile.check()
+            response['Server-Timing'] = profile.server_timing()
+        return response
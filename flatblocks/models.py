@@ -1,9 +1,29 @@
 from django.contrib.sites.models import Site
 from django.db import models
+from django.db.models.signals import post_init, post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
-from django.core.cache import cache
 
-from flatblocks.settings import CACHE_PREFIX
+from flatblocks import caching
+
+
+class FlatBlockQuerySet(models.query.QuerySet):
+    def update(self, **kwargs):
+        # Bulk updates don't send any signals, so invalidate the cache of
+        # all the affected sites at once
+        site_ids = set(self.values_list('site_id', flat=True))
+        rows = super(FlatBlockQuerySet, self).update(**kwargs)
+        if 'site' in kwargs or 'site_id' in kwargs:
+            caching.invalidate_all()
+        else:
+            for site_id in site_ids:
+                caching.invalidate_site(site_id)
+        return rows
+    update.alters_data = True
+
+
+class FlatBlockManager(models.Manager):
+    def get_query_set(self):
+        return FlatBlockQuerySet(self.model, using=self._db)
 
 
 class FlatBlock(models.Model):
@@ -22,6 +42,8 @@ class FlatBlock(models.Model):
                 null=True)
     site = models.ForeignKey(Site, related_name='flatblocks', verbose_name=_('Site'))
 
+    objects = FlatBlockManager()
+
     class Meta:
         verbose_name = _('Flat block')
         verbose_name_plural = _('Flat blocks')
@@ -32,7 +54,27 @@ class FlatBlock(models.Model):
     def __unicode__(self):
         return u"%s" % (self.slug,)
 
-    def save(self, *args, **kwargs):
-        super(FlatBlock, self).save(*args, **kwargs)
-        # Now also invalidate the cache used in the templatetag
-        cache.delete('%s%s' % (CACHE_PREFIX, self.slug, ))
+
+def remember_flatblock_key(sender, instance, **kwargs):
+    """
+    Remembers the site and slug a flatblock was loaded with, so that the
+    cache of both can be invalidated when it is renamed or moved.
+    """
+    instance._original_key = (instance.site_id, instance.slug)
+
+
+def invalidate_flatblock_cache(sender, instance, **kwargs):
+    """
+    Invalidates the cache used in the templatetag whenever a flatblock is
+    saved or deleted.
+    """
+    caching.invalidate_block(instance.site_id, instance.slug)
+    original = getattr(instance, '_original_key', None)
+    if original is not None and original[0] is not None and \
+            original != (instance.site_id, instance.slug):
+        caching.invalidate_block(*original)
+    instance._original_key = (instance.site_id, instance.slug)
+
+post_init.connect(remember_flatblock_key, sender=FlatBlock)
+post_save.connect(invalidate_flatblock_cache, sender=FlatBlock)
+post_delete.connect(invalidate_flatblock_cache, sender=FlatBlock)
@@ -0,0 +1,78 @@
+"""
+Batch loading of the flatblocks a template is going to render.
+
+While a template is compiled, every ``{% flatblock %}`` and
+``{% plain_flatblock %}`` tag with a hard-coded slug registers that slug in
+a ``SlugGroup`` which is shared by all the tags compiled by the same parser
+(i.e. all the tags of one template file).
+
+When the first tag of a group needs to hit the database during a rendering,
+all the slugs of its group are fetched with a single ``slug__in`` query. The
+result is kept in the render context for the rest of that rendering, which
+also covers the templates pulled in through ``{% extends %}`` and
+``{% include %}``, so any tag asking for an already loaded slug (static or
+variable) doesn't touch the database again. Every template file containing
+flatblocks costs at most one query per rendering.
+"""
+
+from flatblocks.models import FlatBlock
+
+
+RENDER_CONTEXT_KEY = 'flatblocks.prefetch'
+
+
+class SlugGroup(object):
+    """
+    The static slugs used by the flatblock tags of a single template.
+    """
+    def __init__(self):
+        self.slugs = set()
+
+    def add(self, slug):
+        self.slugs.add(slug)
+
+
+def get_slug_group(parser):
+    """
+    Returns the ``SlugGroup`` of the template currently compiled by
+    ``parser``, creating it on first use.
+    """
+    group = getattr(parser, 'flatblock_slug_group', None)
+    if group is None:
+        group = parser.flatblock_slug_group = SlugGroup()
+    return group
+
+
+class PrefetchedBlocks(object):
+    """
+    The flatblocks loaded during one rendering, keyed by site id and slug.
+    A value of ``None`` means that the block is known not to exist.
+    """
+    def __init__(self):
+        self.blocks = {}
+
+    def load(self, slugs, site):
+        slugs = [slug for slug in slugs if (site.pk, slug) not in self.blocks]
+        if not slugs:
+            return
+        for slug in slugs:
+            self.blocks[(site.pk, slug)] = None
+        for block in FlatBlock.objects.filter(slug__in=slugs, site=site):
+            self.blocks[(site.pk, block.slug)] = block
+
+    def get(self, slug, site, group=None):
+        key = (site.pk, slug)
+        if key not in self.blocks:
+            slugs = set([slug])
+            if group is not None:
+                slugs.update(group.slugs)
+            self.load(slugs, site)
+        block = self.blocks[key]
+        if block is None:
+            raise FlatBlock.DoesNotExist(
+                "FlatBlock matching query does not exist.")
+        return block
+
+    def add(self, block):
+        self.blocks[(block.site_id, block.slug)] = block
+
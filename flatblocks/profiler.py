@@ -0,0 +1,174 @@
+"""
+Profiling the flatblock lookups of a request.
+
+``flatblocks.middleware.FlatBlockProfilerMiddleware``, or the
+``profile_flatblocks()`` context manager, records every flatblock lookup of
+the current thread: its slug and site, where it was served from (``cache``,
+``negative`` for a cached absence, or ``db``), the time spent in the
+database and the template of the tag that made it (known with
+``TEMPLATE_DEBUG`` only)::
+
+    from flatblocks.profiler import profile_flatblocks
+
+    with profile_flatblocks(max_db_lookups=5, strict=True) as profile:
+        response = self.client.get('/')
+    self.assertEqual(0, profile.db_lookups)
+
+When the same flatblock is looked up more than once, or when more than
+``max_db_lookups`` (``FLATBLOCKS_PROFILER_MAX_DB_LOOKUPS`` for the
+middleware) lookups hit the database, a ``FlatBlockProfilerWarning`` is
+issued, or a ``FlatBlockProfilerError`` raised with ``strict=True``. The
+middleware also adds a ``Server-Timing`` header to the response.
+"""
+
+import threading
+import warnings
+from contextlib import contextmanager
+
+from flatblocks import metrics
+
+
+class FlatBlockProfilerWarning(UserWarning):
+    pass
+
+
+class FlatBlockProfilerError(AssertionError):
+    pass
+
+
+class Lookup(object):
+    def __init__(self, slug, site_id, source, template=None):
+        self.slug = slug
+        self.site_id = site_id
+        self.source = source
+        self.template = template
+        self.db_time = 0.0
+
+    def __repr__(self):
+        return '<Lookup: %s (site %s) from %s>' % (self.slug, self.site_id,
+                                                   self.source)
+
+
+class Profile(object):
+    """
+    The flatblock lookups made while the profile is active. Registered as a
+    listener of ``flatblocks.metrics``.
+    """
+    def __init__(self, max_db_lookups=None):
+        self.max_db_lookups = max_db_lookups
+        self.lookups = []
+        self.render_time = 0.0
+        # Set by the template tags before each lookup
+        self.template = None
+
+    def incr(self, name, site_id, slug, value=1):
+        source = {
+            'cache_hit': 'cache',
+            'negative_hit': 'negative',
+            'db_lookup': 'db',
+        }.get(name)
+        if source is not None:
+            self.lookups.append(Lookup(slug, site_id, source, self.template))
+
+    def timing(self, name, site_id, slug, seconds):
+        if name == 'render':
+            self.render_time += seconds
+        elif name == 'db_time':
+            for lookup in reversed(self.lookups):
+                if lookup.source == 'db' and lookup.slug == slug and \
+                        lookup.site_id == site_id:
+                    lookup.db_time += seconds
+                    break
+
+    @property
+    def db_lookups(self):
+        return len([lookup for lookup in self.lookups
+                    if lookup.source == 'db'])
+
+    @property
+    def db_time(self):
+        return sum(lookup.db_time for lookup in self.lookups)
+
+    def get_problems(self):
+        """
+        Returns descriptions of the flatblocks looked up more than once, and
+        of too many database lookups.
+        """
+        problems = []
+        counts = {}
+        for lookup in self.lookups:
+            key = (lookup.site_id, lookup.slug)
+            counts.setdefault(key, []).append(lookup)
+        for (site_id, slug), lookups in sorted(counts.items()):
+            if len(lookups) > 1:
+                problem = "Flatblock %r of site %s was looked up %d times " \
+                    "(%d from the database)" % (slug, site_id, len(lookups),
+                    len([lookup for lookup in lookups
+                         if lookup.source == 'db']))
+                templates = sorted(set(lookup.template for lookup in lookups
+                                       if lookup.template))
+                if templates:
+                    problem += ' in %s' % ', '.join(templates)
+                problems.append(problem)
+        if self.max_db_lookups is not None and \
+                self.db_lookups > self.max_db_lookups:
+            problems.append("%d flatblocks were loaded from the database, "
+                            "more than %d" % (self.db_lookups,
+                                              self.max_db_lookups))
+        return problems
+
+    def check(self, strict=False):
+        """
+        Warns about the problems of this profile, or raises a
+        ``FlatBlockProfilerError`` if ``strict`` is true.
+        """
+        problems = self.get_problems()
+        if problems and strict:
+            raise FlatBlockProfilerError('\n'.join(problems))
+        for problem in problems:
+            warnings.warn(problem, FlatBlockProfilerWarning, stacklevel=3)
+
+    def server_timing(self):
+        """
+        Returns the value of a ``Server-Timing`` header.
+        """
+        return 'flatblocks;dur=%.2f;desc="%d lookups, %d from db", ' \
+               'flatblocks-db;dur=%.2f, flatblocks-render;dur=%.2f' % (
+                   (self.db_time + self.render_time) * 1000,
+                   len(self.lookups), self.db_lookups, self.db_time * 1000,
+                   self.render_time * 1000)
+
+
+_state = threading.local()
+
+
+def get_profile():
+    """
+    Returns the active profile of the current thread, if any.
+    """
+    return getattr(_state, 'profile', None)
+
+
+def start_profile(max_db_lookups=None):
+    profile = _state.profile = Profile(max_db_lookups)
+    metrics.add_listener(profile)
+    return profile
+
+
+def end_profile():
+    profile = get_profile()
+    if profile is not None:
+        metrics.remove_listener(profile)
+        _state.profile = None
+    return profile
+
+
+@contextmanager
+def profile_flatblocks(max_db_lookups=None, strict=False):
+    profile = start_profile(max_db_lookups)
+    try:
+        yield profile
+    finally:
+        end_profile()
+    profile.check(strict)
+
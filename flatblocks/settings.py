@@ -11,3 +11,78 @@ STRICT_DEFAULT_CHECK_UPDATE = getattr(settings,
     'FLATBLOCKS_STRICT_DEFAULT_CHECK_UPDATE', False)
 
 CACHE_TIMEOUT = getattr(settings, 'FLATBLOCKS_CACHE_TIMEOUT', cache.default_timeout)
+
+# Look flatblocks up for the site matching the host of the request
+SITE_FROM_HOST = getattr(settings, 'FLATBLOCKS_SITE_FROM_HOST', False)
+
+PREFETCH_STATIC_BLOCKS = getattr(settings,
+    'FLATBLOCKS_PREFETCH_STATIC_BLOCKS', True)
+
+# In-process LRU tier in front of the cache backend
+LOCAL_CACHE = getattr(settings, 'FLATBLOCKS_LOCAL_CACHE', False)
+LOCAL_CACHE_MAX_ENTRIES = getattr(settings,
+    'FLATBLOCKS_LOCAL_CACHE_MAX_ENTRIES', 500)
+LOCAL_CACHE_MAX_BYTES = getattr(settings,
+    'FLATBLOCKS_LOCAL_CACHE_MAX_BYTES', 1024 * 1024)
+LOCAL_CACHE_TIMEOUT = getattr(settings, 'FLATBLOCKS_LOCAL_CACHE_TIMEOUT', 60)
+LOCAL_CACHE_VERSION_CHECK = getattr(settings,
+    'FLATBLOCKS_LOCAL_CACHE_VERSION_CHECK', 1)
+
+# Minimum length of the contents compressed in the cache, None to disable
+COMPRESS_THRESHOLD = getattr(settings, 'FLATBLOCKS_COMPRESS_THRESHOLD', None)
+
+# Cache all the flatblocks of a site under a single key
+SITE_BUNDLE = getattr(settings, 'FLATBLOCKS_SITE_BUNDLE', False)
+# Larger bundles fall back to one key per flatblock
+SITE_BUNDLE_MAX_BYTES = getattr(settings, 'FLATBLOCKS_SITE_BUNDLE_MAX_BYTES',
+    512 * 1024)
+
+# Cache the rendered HTML of the flatblock tag instead of the model instance
+CACHE_RENDERED = getattr(settings, 'FLATBLOCKS_CACHE_RENDERED', False)
+# Context variables the rendered HTML depends on, by wrapper template name
+CACHE_RENDERED_VARY_ON = getattr(settings,
+    'FLATBLOCKS_CACHE_RENDERED_VARY_ON', {})
+
+# Seconds to cache the absence of a flatblock, 0 disables negative caching
+NEGATIVE_CACHE_TIMEOUT = getattr(settings,
+    'FLATBLOCKS_NEGATIVE_CACHE_TIMEOUT', 60)
+
+# Let a single process recompute a missing cache entry at a time
+STAMPEDE_PROTECTION = getattr(settings, 'FLATBLOCKS_STAMPEDE_PROTECTION',
+    False)
+STAMPEDE_LOCK_TIMEOUT = getattr(settings,
+    'FLATBLOCKS_STAMPEDE_LOCK_TIMEOUT', 10)
+STAMPEDE_WAIT = getattr(settings, 'FLATBLOCKS_STAMPEDE_WAIT', 0.5)
+STAMPEDE_POLL_INTERVAL = getattr(settings,
+    'FLATBLOCKS_STAMPEDE_POLL_INTERVAL', 0.05)
+# Fraction by which cache timeouts are randomly varied
+CACHE_TIMEOUT_JITTER = getattr(settings, 'FLATBLOCKS_CACHE_TIMEOUT_JITTER', 0)
+
+# Serve expired flatblocks while they are reloaded in the background
+STALE_WHILE_REVALIDATE = getattr(settings,
+    'FLATBLOCKS_STALE_WHILE_REVALIDATE', False)
+STALE_TIMEOUT = getattr(settings, 'FLATBLOCKS_STALE_TIMEOUT', 300)
+REFRESH_THREADS = getattr(settings, 'FLATBLOCKS_REFRESH_THREADS', 2)
+REFRESH_MAX_QUEUED = getattr(settings, 'FLATBLOCKS_REFRESH_MAX_QUEUED', 100)
+
+# Defer the writes of autocreation and strict default checks
+WRITE_BEHIND = getattr(settings, 'FLATBLOCKS_WRITE_BEHIND', False)
+WRITE_BEHIND_INTERVAL = getattr(settings, 'FLATBLOCKS_WRITE_BEHIND_INTERVAL',
+    1)
+WRITE_BEHIND_BATCH_SIZE = getattr(settings,
+    'FLATBLOCKS_WRITE_BEHIND_BATCH_SIZE', 100)
+
+# Where flatblocks are looked up: 'cache' (cache and database) or 'snapshot'
+BACKEND = getattr(settings, 'FLATBLOCKS_BACKEND', 'cache')
+SNAPSHOT_PATH = getattr(settings, 'FLATBLOCKS_SNAPSHOT_PATH', None)
+SNAPSHOT_CHECK_INTERVAL = getattr(settings,
+    'FLATBLOCKS_SNAPSHOT_CHECK_INTERVAL', 1)
+
+# Count cache hits, database lookups etc. by site and slug
+METRICS = getattr(settings, 'FLATBLOCKS_METRICS', False)
+METRICS_SINKS = getattr(settings, 'FLATBLOCKS_METRICS_SINKS',
+    ('flatblocks.metrics.AggregateSink',))
+
+# Database lookups per request above which the profiler middleware warns
+PROFILER_MAX_DB_LOOKUPS = getattr(settings,
+    'FLATBLOCKS_PROFILER_MAX_DB_LOOKUPS', None)
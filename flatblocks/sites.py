@@ -0,0 +1,65 @@
+"""
+Resolution of the site flatblocks are looked up for.
+
+By default this is the site of the ``SITE_ID`` setting. For installations
+serving several sites from one process, ``get_current_site()`` prefers the
+``site`` attribute of the request, if a middleware set one, and with
+``FLATBLOCKS_SITE_FROM_HOST`` the site whose domain matches the host of the
+request. The sites are kept in a host -> site map which is loaded with a
+single query and, like Django's own ``SITE_CACHE``, cleared when a site is
+saved or deleted in this process.
+
+With ``FLATBLOCKS_BACKEND = 'snapshot'`` the site is resolved without the
+database, as the snapshot only needs its id: it is ``request.site`` or an
+unsaved ``Site`` with the id of ``SITE_ID``.
+"""
+
+import threading
+
+from django.conf import settings as django_settings
+from django.contrib.sites.models import Site
+from django.db.models.signals import post_save, post_delete
+
+from flatblocks import settings
+
+
+_sites_by_host = None
+_lock = threading.Lock()
+
+
+def get_site_by_host(host):
+    """
+    Returns the site with the given domain (without the port), or ``None``.
+    """
+    global _sites_by_host
+    sites = _sites_by_host
+    if sites is None:
+        with _lock:
+            sites = _sites_by_host = dict(
+                (site.domain.lower(), site) for site in Site.objects.all())
+    return sites.get(host.lower())
+
+
+def get_current_site(request=None):
+    """
+    Returns the site of the given request, falling back to the site of the
+    ``SITE_ID`` setting.
+    """
+    site = getattr(request, 'site', None)
+    if site is not None:
+        return site
+    if settings.BACKEND == 'snapshot':
+        return Site(pk=django_settings.SITE_ID)
+    if request is not None and settings.SITE_FROM_HOST:
+        site = get_site_by_host(request.get_host().split(':')[0])
+        if site is not None:
+            return site
+    return Site.objects.get_current()
+
+
+def clear_site_map(sender, **kwargs):
+    global _sites_by_host
+    _sites_by_host = None
+
+post_save.connect(clear_site_map, sender=Site)
+post_delete.connect(clear_site_map, sender=Site)
@@ -0,0 +1,122 @@
+"""
+Serving flatblocks from a snapshot file.
+
+The ``exportflatblocks`` command writes all the flatblocks (of some sites)
+into a single marshal file. With ``FLATBLOCKS_BACKEND = 'snapshot'`` every
+lookup is served from an in-memory copy of the file at
+``FLATBLOCKS_SNAPSHOT_PATH``, so rendering flatblocks needs neither the
+database nor the cache. Blocks missing from the snapshot are treated as
+missing; nothing is created.
+
+The file is loaded on the first lookup. Afterwards it is checked at most
+once every ``FLATBLOCKS_SNAPSHOT_CHECK_INTERVAL`` seconds, and reloaded when
+it was replaced. Exports write a temporary file that is renamed over the
+previous one, and a reload replaces the whole in-memory copy at once, so a
+lookup sees either the old or the new snapshot.
+"""
+
+import marshal
+import os
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from flatblocks import settings
+from flatblocks.caching import CachedFlatBlock
+
+
+# Version of the snapshot file format
+FORMAT_VERSION = 1
+
+
+def export_snapshot(path, flatblocks):
+    """
+    Writes the given flatblocks to a snapshot file, replacing the existing
+    file atomically. Returns the number of flatblocks written.
+    """
+    blocks = {}
+    for pk, site_id, slug, header, content in flatblocks.values_list(
+            'pk', 'site', 'slug', 'header', 'content').iterator():
+        blocks.setdefault(site_id, {})[slug] = (pk, header, content)
+    data = {
+        'version': FORMAT_VERSION,
+        'created': time.time(),
+        'blocks': blocks,
+    }
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmp_path, 'wb')
+    try:
+        marshal.dump(data, f)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+    return sum(len(site_blocks) for site_blocks in blocks.values())
+
+
+class Snapshot(object):
+    """
+    The in-memory copy of a snapshot file.
+    """
+    def __init__(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self.blocks = None
+        self.stamp = None
+        self.checked = 0
+        self._lock = threading.Lock()
+
+    def get_stamp(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def load(self):
+        stamp = self.get_stamp()
+        f = open(self.path, 'rb')
+        try:
+            data = marshal.load(f)
+        finally:
+            f.close()
+        if data.get('version') != FORMAT_VERSION:
+            raise ImproperlyConfigured("%s is not a flatblocks snapshot of "
+                "version %s" % (self.path, FORMAT_VERSION))
+        blocks = {}
+        for site_id, site_blocks in data['blocks'].items():
+            for slug, (pk, header, content) in site_blocks.items():
+                blocks[(site_id, slug)] = CachedFlatBlock(pk, site_id, slug,
+                                                          header, content)
+        self.blocks, self.stamp = blocks, stamp
+
+    def refresh(self, now=None):
+        """
+        Loads the file if it hasn't been loaded yet or has been replaced.
+        """
+        now = now or time.time()
+        if self.blocks is not None and \
+                now - self.checked < self.check_interval:
+            return
+        with self._lock:
+            if self.blocks is None or self.get_stamp() != self.stamp:
+                self.load()
+            self.checked = now
+
+    def get(self, site_id, slug):
+        self.refresh()
+        return self.blocks.get((site_id, slug))
+
+
+_snapshot = None
+
+
+def get_snapshot():
+    """
+    Returns the ``Snapshot`` of ``FLATBLOCKS_SNAPSHOT_PATH``.
+    """
+    global _snapshot
+    if not settings.SNAPSHOT_PATH:
+        raise ImproperlyConfigured("FLATBLOCKS_SNAPSHOT_PATH has to be set "
+                                   "to use the snapshot backend")
+    if _snapshot is None or _snapshot.path != settings.SNAPSHOT_PATH:
+        _snapshot = Snapshot(settings.SNAPSHOT_PATH,
+                             settings.SNAPSHOT_CHECK_INTERVAL)
+    return _snapshot
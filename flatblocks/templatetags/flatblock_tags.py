@@ -39,26 +39,88 @@ content but the whole object inclusing title, slug and id. This way you
 can easily for example offer administrative operations (like editing)
 within that template.
 
+The 'flatblocks' template tag loads several flatblocks at once, with a single
+cache lookup and a single query, and stores them in a context variable as an
+ordered dictionary mapping their slugs to the flatblocks::
+
+    {% flatblocks promo_slugs 3600 as promos %}
+    {% for flatblock in promos.values %}
+        {% include "flatblocks/flatblock.html" %}
+    {% endfor %}
+
 """
 
+import time
+
 from django import template
-from django.contrib.sites.models import Site
-from django.core.cache import cache
 # from django.db import models
 from django.template import loader
 from django.template import debug as template_debug
 
-from flatblocks import settings
-from flatblocks.models import FlatBlock
-
-import logging
+from flatblocks import caching, metrics, profiler, settings
+from flatblocks.api import BlockLoader
+from flatblocks.prefetch import get_slug_group
+from flatblocks.sites import get_current_site
 
 
 register = template.Library()
-logger = logging.getLogger(__name__)
+
+# Compiled template.Variable instances for FLATBLOCKS_CACHE_RENDERED_VARY_ON
+_vary_on_variables = {}
+
+
+def get_block_loader(context):
+    """
+    Returns the ``BlockLoader`` of the current rendering.
+
+    The render context is pushed for every rendered template, so the loader
+    is kept in its outermost scope, which lives as long as the top-level
+    ``Template.render()`` call.
+    """
+    scope = context.render_context.dicts[0]
+    block_loader = scope.get('flatblocks.loader')
+    if block_loader is None:
+        block_loader = scope['flatblocks.loader'] = BlockLoader()
+    return block_loader
+
+
+def get_site(context):
+    """
+    Returns the site of the current rendering, taken from the ``request``
+    context variable if there is one, and resolved once per rendering.
+    """
+    scope = context.render_context.dicts[0]
+    site = scope.get('flatblocks.site')
+    if site is None:
+        site = scope['flatblocks.site'] = get_current_site(
+            context.get('request'))
+    return site
+
+
+def set_profile_template(node):
+    """
+    Tells the active profiler, if any, which template the lookups of the
+    node are made from. Nodes only know their origin with TEMPLATE_DEBUG.
+    """
+    profile = profiler.get_profile()
+    if profile is not None:
+        source = getattr(node, 'source', None)
+        profile.template = source and source[0].name or None
+
+
+class FlatBlockTag(object):
+    """
+    The arguments of one flatblock tag, as parsed by
+    ``BasicFlatBlockWrapper.prepare()``.
+    """
 
 
 class BasicFlatBlockWrapper(object):
+    """
+    Compiles flatblock tags. The instances registered with the library are
+    shared by all the threads compiling templates, so they don't keep any
+    state: the arguments of each tag are returned in a new ``FlatBlockTag``.
+    """
     def prepare(self, parser, token):
         """
         The parser checks for following tag-configurations::
@@ -67,14 +129,20 @@ class BasicFlatBlockWrapper(object):
             {% flatblock {block} {timeout} %}
             {% flatblock {block} using {tpl_name} %}
             {% flatblock {block} {timeout} using {tpl_name} %}
+
+        each optionally followed by ``only``.
         """
         tokens = token.split_contents()
-        self.is_variable = False
-        self.tpl_is_variable = False
-        self.slug = None
-        self.cache_time = 0
-        self.tpl_name = None
-        tag_name, self.slug, args = tokens[0], tokens[1], tokens[2:]
+        if len(tokens) < 2:
+            raise template.TemplateSyntaxError(
+                "%r tag requires the name of a flatblock" % (tokens[0],))
+        tag = FlatBlockTag()
+        tag.is_variable = False
+        tag.tpl_is_variable = False
+        tag.slug = None
+        tag.cache_time = 0
+        tag.tpl_name = None
+        tag_name, tag.slug, args = tokens[0], tokens[1], tokens[2:]
 
         try:
             # Split the arguments in two sections, the "core" ones
@@ -85,21 +153,26 @@ class BasicFlatBlockWrapper(object):
         except ValueError:
             default_args = []
 
+        # Only pass the flatblock to the wrapper template
+        tag.only = bool(args) and args[-1] == 'only'
+        if tag.only:
+            args = args[:-1]
+
         num_args = len(args)
         if num_args == 0:
             # Only the block name was specified
             pass
         elif num_args == 1:
             # block and timeout
-            self.cache_time = args[0]
+            tag.cache_time = args[0]
             pass
         elif num_args == 2:
             # block, "using", tpl_name
-            self.tpl_name = args[1]
+            tag.tpl_name = args[1]
         elif num_args == 3:
             # block, timeout, "using", tpl_name
-            self.cache_time = args[0]
-            self.tpl_name = args[2]
+            tag.cache_time = args[0]
+            tag.tpl_name = args[2]
         else:
             raise template.TemplateSyntaxError, "%r tag should have between 1 and 4 arguments" % (tokens[0],)
 
@@ -109,7 +182,7 @@ class BasicFlatBlockWrapper(object):
             # the closing tag, and keep the parsed nodelist for later
             # rendering
             end_tag_name = 'end_%s' % tag_name
-            self.inner_nodelist = parser.parse((end_tag_name, ))
+            tag.inner_nodelist = parser.parse((end_tag_name, ))
             parser.delete_first_token()
 
             if len(default_args) > 2:
@@ -120,62 +193,110 @@ class BasicFlatBlockWrapper(object):
             # as the flatblock's header
 
             if len(default_args) == 2:
-                self.default_header = default_args[1]
-                if self.default_header[0] == self.default_header[-1] and \
-                   self.default_header[0] in ('"', "'"):
-                    self.default_header = self.default_header[1:-1]
-                    self.default_header_is_variable = False
+                tag.default_header = default_args[1]
+                if tag.default_header[0] == tag.default_header[-1] and \
+                   tag.default_header[0] in ('"', "'"):
+                    tag.default_header = tag.default_header[1:-1]
+                    tag.default_header_is_variable = False
                 else:
-                    self.default_header_is_variable = True
+                    tag.default_header_is_variable = True
             else:
-                self.default_header = None
-                self.default_header_is_variable = False
+                tag.default_header = None
+                tag.default_header_is_variable = False
         else:
-            self.default_header = None
-            self.default_header_is_variable = False
-            self.inner_nodelist = None
+            tag.default_header = None
+            tag.default_header_is_variable = False
+            tag.inner_nodelist = None
 
         # Check to see if the slug is properly double/single quoted
-        if not (self.slug[0] == self.slug[-1] and self.slug[0] in ('"', "'")):
-            self.is_variable = True
+        if not (tag.slug[0] == tag.slug[-1] and tag.slug[0] in ('"', "'")):
+            tag.is_variable = True
         else:
-            self.slug = self.slug[1:-1]
+            tag.slug = tag.slug[1:-1]
+        # Remember the hard-coded slugs of this template so that they can
+        # all be fetched at once when the template gets rendered
+        if tag.is_variable:
+            tag.slug_group = None
+        else:
+            tag.slug_group = get_slug_group(parser)
+            tag.slug_group.add(tag.slug)
         # Clean up the template name
-        if self.tpl_name is not None:
-            if not(self.tpl_name[0] == self.tpl_name[-1] and self.tpl_name[0] in ('"', "'")):
-                self.tpl_is_variable = True
+        if tag.tpl_name is not None:
+            if not(tag.tpl_name[0] == tag.tpl_name[-1] and tag.tpl_name[0] in ('"', "'")):
+                tag.tpl_is_variable = True
             else:
-                self.tpl_name = self.tpl_name[1:-1]
-        if self.cache_time is not None and self.cache_time != 'None':
-            self.cache_time = int(self.cache_time)
+                tag.tpl_name = tag.tpl_name[1:-1]
+        if tag.cache_time is not None and tag.cache_time != 'None':
+            tag.cache_time = int(tag.cache_time)
+        return tag
 
     def __call__(self, parser, token):
-        self.prepare(parser, token)
-        return FlatBlockNode(self.slug, self.is_variable, self.cache_time,
-                template_name=self.tpl_name,
-                tpl_is_variable=self.tpl_is_variable,
-                default_header=self.default_header,
-                default_header_is_variable=self.default_header_is_variable,
-                default_content=self.inner_nodelist)
+        tag = self.prepare(parser, token)
+        return FlatBlockNode(tag.slug, tag.is_variable, tag.cache_time,
+                template_name=tag.tpl_name,
+                tpl_is_variable=tag.tpl_is_variable,
+                default_header=tag.default_header,
+                default_header_is_variable=tag.default_header_is_variable,
+                default_content=tag.inner_nodelist,
+                slug_group=tag.slug_group, only=tag.only)
 
 class PlainFlatBlockWrapper(BasicFlatBlockWrapper):
     def __call__(self, parser, token):
-        self.prepare(parser, token)
+        tag = self.prepare(parser, token)
+        if tag.only:
+            # There is no wrapper template to isolate
+            raise template.TemplateSyntaxError(
+                "%r tag doesn't accept 'only'" % (token.contents.split()[0],))
         return FlatBlockNode(
-            self.slug, self.is_variable, self.cache_time, False,
-            default_header=self.default_header,
-            default_header_is_variable=self.default_header_is_variable,
-            default_content=self.inner_nodelist,
+            tag.slug, tag.is_variable, tag.cache_time, False,
+            default_header=tag.default_header,
+            default_header_is_variable=tag.default_header_is_variable,
+            default_content=tag.inner_nodelist,
+            slug_group=tag.slug_group,
         )
 
 do_get_flatblock = BasicFlatBlockWrapper()
 do_plain_flatblock = PlainFlatBlockWrapper()
 
+class FlatBlockDefaults(object):
+    """
+    The ``with-default`` header and content of a flatblock tag, resolved
+    against the context on first access only: they are not needed at all
+    when the flatblock exists.
+    """
+    def __init__(self, node, context):
+        self.node = node
+        self.context = context
+
+    @property
+    def header(self):
+        if not hasattr(self, '_header'):
+            if isinstance(self.node.default_header, template.Variable):
+                self._header = self.node.default_header.resolve(self.context)
+            else:
+                self._header = self.node.default_header
+        return self._header
+
+    @property
+    def content(self):
+        if not hasattr(self, '_content'):
+            if isinstance(self.node.default_content,
+                          (template.NodeList, template_debug.DebugNodeList)):
+                self._content = self.node.default_content.render(self.context)
+            else:
+                self._content = self.node.default_content
+        return self._content
+
+    @property
+    def has_content(self):
+        return bool(self.node.default_content)
+
+
 class FlatBlockNode(template.Node):
     def __init__(self, slug, is_variable, cache_time=0, with_template=True,
                  template_name=None, tpl_is_variable=False,
                  default_header=None, default_header_is_variable=None,
-                 default_content=None):
+                 default_content=None, slug_group=None, only=False):
         if template_name is None:
             self.template_name = 'flatblocks/flatblock.html'
         else:
@@ -183,8 +304,12 @@ class FlatBlockNode(template.Node):
                 self.template_name = template.Variable(template_name)
             else:
                 self.template_name = template_name
+        # Compiled on first use if the template name is static
+        self.template = None
         self.slug = slug
         self.is_variable = is_variable
+        if is_variable:
+            self.slug_variable = template.Variable(slug)
         self.cache_time = cache_time
         self.with_template = with_template
 
@@ -193,11 +318,13 @@ class FlatBlockNode(template.Node):
                              if default_header_is_variable \
                              else default_header
         self.default_content = default_content
+        self.slug_group = slug_group
+        self.only = only
 
     def render(self, context):
-        current_site = Site.objects.get_current()
+        current_site = get_site(context)
         if self.is_variable:
-            real_slug = template.Variable(self.slug).resolve(context)
+            real_slug = self.slug_variable.resolve(context)
         else:
             real_slug = self.slug
 
@@ -206,106 +333,217 @@ class FlatBlockNode(template.Node):
         else:
             real_template = self.template_name
 
-        if isinstance(self.default_header, template.Variable):
-            real_default_header = self.default_header.resolve(context)
-        else:
-            real_default_header = self.default_header
+        block_loader = get_block_loader(context)
+
+        # With FLATBLOCKS_CACHE_RENDERED a cached fragment spares us
+        # everything else, including the rendering of the wrapper template
+        fragment_key = None
+        if settings.CACHE_RENDERED and self.with_template and \
+                self.cache_time != 0 and settings.BACKEND != 'snapshot':
+            # With "only" the wrapper template can't see any other variable
+            vary_on = not self.only and \
+                self.resolve_vary_on(real_template, context) or ()
+            fragment_key = caching.fragment_key(current_site.pk, real_slug,
+                block_loader.get_generation(current_site.pk), real_template,
+                vary_on, self.only)
+            output, version = caching.get_fragment(fragment_key,
+                                                   current_site.pk, real_slug)
+            if output is not None:
+                return output
+
+        # if flatblock's slug is hard-coded in template then it is
+        # safe and convenient to auto-create block if it doesn't exist.
+        # This behaviour can be configured using the
+        # FLATBLOCKS_AUTOCREATE_STATIC_BLOCKS setting
+        autocreate = not self.is_variable and \
+            settings.AUTOCREATE_STATIC_BLOCKS
+
+        set_profile_template(self)
+        flatblock = block_loader.get_block(real_slug, current_site,
+            self.cache_time, autocreate, FlatBlockDefaults(self, context),
+            self.slug_group)
+        if flatblock is None:
+            return ''
 
-        if isinstance(self.default_content,
-                      (template.NodeList, template_debug.DebugNodeList)):
-            real_default_contents = self.default_content.render(context)
-        else:
-            real_default_contents = self.default_content
+        output = self.flatblock_output(real_template, flatblock, context)
+        if fragment_key is not None and flatblock.pk is not None:
+            caching.set_fragment(fragment_key, version, output,
+                                 self.get_cache_timeout())
+        return output
+
+    def get_cache_timeout(self):
+        if self.cache_time is None or self.cache_time == 'None':
+            return settings.CACHE_TIMEOUT
+        return int(self.cache_time)
 
+    def resolve_vary_on(self, template_name, context):
+        """
+        Returns the values of the context variables the rendered output of
+        the given wrapper template depends on, as configured in
+        FLATBLOCKS_CACHE_RENDERED_VARY_ON.
+        """
+        values = []
+        for name in settings.CACHE_RENDERED_VARY_ON.get(template_name, ()):
+            variable = _vary_on_variables.get(name)
+            if variable is None:
+                variable = _vary_on_variables[name] = template.Variable(name)
+            try:
+                values.append(variable.resolve(context))
+            except template.VariableDoesNotExist:
+                values.append(None)
+        return values
+
+    def get_template(self, template_name):
+        if isinstance(self.template_name, template.Variable):
+            return loader.get_template(template_name)
+        if self.template is None:
+            self.template = loader.get_template(template_name)
+        return self.template
+
+    def flatblock_output(self, template_name, flatblock, context):
+        if not self.with_template:
+            return flatblock.content
+        if metrics.is_enabled():
+            started = time.time()
+            try:
+                return self.render_template(template_name, flatblock,
+                                            context)
+            finally:
+                metrics.timing('render', flatblock.site_id, flatblock.slug,
+                               time.time() - started)
+        return self.render_template(template_name, flatblock, context)
+
+    def render_template(self, template_name, flatblock, context):
+        tmpl = self.get_template(template_name)
+        if self.only:
+            return tmpl.render(template.Context({'flatblock': flatblock},
+                                                autoescape=context.autoescape))
         # Eventually we want to pass the whole context to the template so that
         # users have the maximum of flexibility of what to do in there.
-        if self.with_template:
-            new_ctx = template.Context()
-            new_ctx.update(context)
+        context.push()
+        try:
+            context['flatblock'] = flatblock
+            return tmpl.render(context)
+        finally:
+            context.pop()
+
+
+def do_flatblocks(parser, token):
+    """
+    The parser checks for following tag-configurations::
+
+        {% flatblocks {block} [{block} ...] as {varname} %}
+        {% flatblocks {block} [{block} ...] {timeout} as {varname} %}
+
+    Every {block} is either a quoted slug or a variable holding a slug or a
+    list of slugs. The timeout has to be an integer or None. As with the
+    flatblock tag, ``with-default`` may follow, closed by
+    ``{% end_flatblocks %}``.
+    """
+    tokens = token.split_contents()
+    tag_name, args = tokens[0], tokens[1:]
+    try:
+        with_index = args.index('with-default')
+        default_args = args[with_index:]
+        args = args[:with_index]
+    except ValueError:
+        default_args = []
+
+    if len(args) < 3 or args[-2] != 'as':
+        raise template.TemplateSyntaxError(
+            "%r tag should end with 'as {varname}'" % (tag_name,))
+    varname = args[-1]
+    args = args[:-2]
+
+    cache_time = 0
+    if args[-1] == 'None' or args[-1].isdigit():
+        cache_time = args.pop()
+        if cache_time == 'None':
+            cache_time = None
         else:
-            new_ctx = None
+            cache_time = int(cache_time)
+    if not args:
+        raise template.TemplateSyntaxError(
+            "%r tag needs at least one block" % (tag_name,))
+
+    slugs = []
+    for arg in args:
+        if arg[0] == arg[-1] and arg[0] in ('"', "'"):
+            slugs.append((arg[1:-1], False))
+        elif arg == 'None' or arg.isdigit():
+            raise template.TemplateSyntaxError(
+                "%r tag expects a quoted slug or a variable, not %s"
+                % (tag_name, arg))
+        else:
+            slugs.append((template.Variable(arg), True))
+
+    default_header = None
+    default_content = None
+    if default_args:
+        if len(default_args) > 2:
+            raise template.TemplateSyntaxError(
+                u'Too many arguments for this block header')
+        default_content = parser.parse(('end_%s' % tag_name, ))
+        parser.delete_first_token()
+        if len(default_args) == 2:
+            default_header = default_args[1]
+            if default_header[0] == default_header[-1] and \
+               default_header[0] in ('"', "'"):
+                default_header = default_header[1:-1]
+            else:
+                default_header = template.Variable(default_header)
 
-        try:
-            flatblock = None
-            if self.cache_time != 0:
-                cache_key = settings.CACHE_PREFIX + real_slug
-                flatblock = cache.get(cache_key)
-
-            if flatblock is None:
-                flatblock_created = False
-
-                # if flatblock's slug is hard-coded in template then it is
-                # safe and convenient to auto-create block if it doesn't exist.
-                # This behaviour can be configured using the
-                # FLATBLOCKS_AUTOCREATE_STATIC_BLOCKS setting
-                if self.is_variable or not settings.AUTOCREATE_STATIC_BLOCKS:
-                    flatblock = FlatBlock.objects.get(slug=real_slug, site=current_site)
-                else:
-                    # try:
-                    #     flatblock = FlatBlock.objects.get(slug=real_slug, site=current_site)
-                    # except FlatBlock.DoesNotExist:
-                    #     flatblock = FlatBlock.objects.create(
-                    #         slug=real_slug,
-                    #         content=real_default_contents or real_slug,
-                    #         header=real_default_header,
-                    #         site=current_site
-                    #     )
-                    #     flatblock.save()
-                    #     flatblock_created = True
-                    flatblock, flatblock_created = FlatBlock.objects.get_or_create(
-                        slug=real_slug, site=current_site, defaults={
-                            'content': real_default_contents or real_slug,
-                            'header': real_default_header,
-                        }
-                    )
-
-                # If the flatblock exists, but its fields are empty, and
-                # the STRICT_DEFAULT_CHECK is True, then update the fields
-                # with the default contents.
-                flatblock_updated = False
-                if not flatblock_created and settings.STRICT_DEFAULT_CHECK:
-                    if not flatblock.header and not real_default_header is None:
-                        flatblock.header = real_default_header
-                        flatblock_updated = True
-                    if not flatblock.content and self.default_content:
-                        flatblock.content = real_default_contents or real_slug
-                        flatblock_updated = True
-
-                    if flatblock_updated and settings.STRICT_DEFAULT_CHECK_UPDATE:
-                        flatblock.save()
-
-                if self.cache_time != 0:
-                    if self.cache_time is None or self.cache_time == 'None':
-                        logger.debug("Caching %s for the cache's default timeout"
-                                % (real_slug,))
-                        cache.set(cache_key, flatblock, settings.CACHE_TIMEOUT)
-                    else:
-                        logger.debug("Caching %s for %s seconds" % (real_slug,
-                            str(self.cache_time)))
-                        cache.set(cache_key, flatblock, int(self.cache_time))
-                else:
-                    logger.debug("Don't cache %s" % (real_slug,))
-
-            return self.flatblock_output(real_template, flatblock, new_ctx)
-        except FlatBlock.DoesNotExist:
-            if real_default_contents:
-                flatblock = FlatBlock(
-                    slug=real_slug,
-                    content=real_default_contents,
-                    header=real_default_header,
-                    site=current_site,
-                )
-                return self.flatblock_output(real_template, flatblock, new_ctx)
-            return ''
+    return FlatBlocksNode(slugs, cache_time, varname,
+                          default_header=default_header,
+                          default_content=default_content)
 
-    def flatblock_output(self, template_name, flatblock, context=None):
-        if not self.with_template:
-            return flatblock.content
-        tmpl = loader.get_template(template_name)
-        context = context or {}
-        context.update({'flatblock': flatblock, })
-        return tmpl.render(template.Context(context))
+
+class FlatBlocksNode(template.Node):
+    """
+    Loads several flatblocks at once into a context variable, as an ordered
+    dictionary mapping the slugs to the flatblocks. Blocks that don't exist
+    and have no default content are left out.
+    """
+    def __init__(self, slugs, cache_time, varname, default_header=None,
+                 default_content=None):
+        self.slugs = slugs
+        self.cache_time = cache_time
+        self.varname = varname
+        self.default_header = default_header
+        self.default_content = default_content
+
+    def resolve_slugs(self, context):
+        """
+        Returns the unique slugs in order, and those that were hard-coded.
+        """
+        slugs, seen, static_slugs = [], set(), set()
+        for slug, is_variable in self.slugs:
+            if not is_variable:
+                static_slugs.add(slug)
+                values = [slug]
+            else:
+                values = slug.resolve(context) or []
+                if isinstance(values, basestring):
+                    values = [values]
+            for value in values:
+                if value not in seen:
+                    seen.add(value)
+                    slugs.append(value)
+        return slugs, static_slugs
+
+    def render(self, context):
+        slugs, static_slugs = self.resolve_slugs(context)
+        if settings.AUTOCREATE_STATIC_BLOCKS:
+            autocreate = static_slugs
+        else:
+            autocreate = ()
+        set_profile_template(self)
+        context[self.varname] = get_block_loader(context).get_blocks(slugs,
+            get_site(context), self.cache_time, autocreate,
+            FlatBlockDefaults(self, context))
+        return ''
 
 
 register.tag('flatblock', do_get_flatblock)
 register.tag('plain_flatblock', do_plain_flatblock)
+register.tag('flatblocks', do_flatblocks)
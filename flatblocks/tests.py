@@ -6,7 +6,7 @@ from django.contrib.sites.models import Site
 from django import db
 
 from flatblocks.models import FlatBlock
-from flatblocks import settings
+from flatblocks import caching, settings
 
 
 class BasicTests(TestCase):
@@ -37,7 +37,9 @@ class BasicTests(TestCase):
         """
         tpl = template.Template('{% load flatblock_tags %}{% flatblock "block" 60 %}')
         tpl.render(template.Context())
-        name = '%sblock' % settings.CACHE_PREFIX
+        site_id = Site.objects.get_current().pk
+        name = caching.block_key(site_id, 'block',
+                                 caching.get_generation(site_id))
         self.assertNotEquals(None, cache.get(name))
         block = FlatBlock.objects.get(slug='block')
         block.header = 'UPDATED'
@@ -392,3 +394,1725 @@ class TagDefaultTests(TestCase):
         settings.AUTOCREATE_STATIC_BLOCKS = old_setting_autocreate
         settings.STRICT_DEFAULT_CHECK = old_setting_strictcheck
         settings.STRICT_DEFAULT_CHECK_UPDATE = old_setting_strictcheckupdate
+
+
+class PrefetchTests(TestCase):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        for slug in ('block1', 'block2', 'block3'):
+            FlatBlock.objects.create(slug=slug, header=slug.upper(),
+                                     content=slug, site=self.site)
+        self.old_PREFETCH_STATIC_BLOCKS = settings.PREFETCH_STATIC_BLOCKS
+        settings.PREFETCH_STATIC_BLOCKS = True
+
+    def tearDown(self):
+        settings.PREFETCH_STATIC_BLOCKS = self.old_PREFETCH_STATIC_BLOCKS
+
+    def testSingleQuery(self):
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% plain_flatblock "block1" %}'
+                                '{% plain_flatblock "block2" %}'
+                                '{% plain_flatblock "block3" %}'
+                                '{% plain_flatblock "missing" %}')
+        with self.assertNumQueries(1):
+            self.assertEqual(u'block1block2block3',
+                             tpl.render(template.Context()))
+
+    def testVariableSlugReusesPrefetchedBlocks(self):
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% plain_flatblock "block1" %}'
+                                '{% plain_flatblock "block2" %}'
+                                '{% plain_flatblock name %}')
+        with self.assertNumQueries(1):
+            self.assertEqual(u'block1block2block2',
+                             tpl.render(template.Context({'name': 'block2'})))
+
+    def testEachRenderingReloads(self):
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% plain_flatblock "block1" %}')
+        self.assertEqual(u'block1', tpl.render(template.Context()))
+        FlatBlock.objects.filter(slug='block1').update(content='UPDATED')
+        self.assertEqual(u'UPDATED', tpl.render(template.Context()))
+
+    def testDisabled(self):
+        settings.PREFETCH_STATIC_BLOCKS = False
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% plain_flatblock "block1" %}'
+                                '{% plain_flatblock "block2" %}')
+        with self.assertNumQueries(2):
+            tpl.render(template.Context())
+
+
+class LocalCacheTests(TestCase):
+    def testLRUEviction(self):
+        local = caching.LocalCache(2, 1024, 60)
+        local.set('a', 'A')
+        local.set('b', 'B')
+        self.assertEqual('A', local.get('a'))
+        local.set('c', 'C')
+        self.assertEqual(None, local.get('b'))
+        self.assertEqual('A', local.get('a'))
+        self.assertEqual('C', local.get('c'))
+
+    def testMaxBytes(self):
+        local = caching.LocalCache(10, 100, 60)
+        local.set('big', 'x' * 200)
+        self.assertEqual(None, local.get('big'))
+        local.set('a', 'x' * 40)
+        local.set('b', 'x' * 40)
+        local.set('c', 'x' * 40)
+        self.assertEqual(None, local.get('a'))
+        self.assertTrue(local.size <= 100)
+
+    def testTimeout(self):
+        local = caching.LocalCache(10, 1024, 60)
+        local.set('a', 'A', 10, now=1000)
+        self.assertEqual('A', local.get('a', now=1009))
+        self.assertEqual(None, local.get('a', now=1010))
+        local.set('b', 'B', None, now=1000)
+        self.assertEqual('B', local.get('b', now=1059))
+        self.assertEqual(None, local.get('b', now=1060))
+
+    def testVersionChange(self):
+        local = caching.VersionedLocalCache(10, 1024, 60, 5)
+        local.check_version(now=1000)
+        local.set('a', 'A', now=1000)
+        cache.set(caching.VERSION_KEY, 'other')
+        # The version is only checked once every 5 seconds
+        self.assertEqual('A', local.get('a', now=1004))
+        self.assertEqual(None, local.get('a', now=1005))
+
+
+class LocalCacheTagTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.old_LOCAL_CACHE = settings.LOCAL_CACHE
+        settings.LOCAL_CACHE = True
+        caching.local_cache.clear()
+        FlatBlock.objects.create(slug='block', content='CONTENT',
+                                 site=Site.objects.get_current())
+
+    def tearDown(self):
+        settings.LOCAL_CACHE = self.old_LOCAL_CACHE
+        caching.local_cache.clear()
+
+    def testServedFromLocalCache(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "block" 60 %}')
+        self.assertEqual(u'CONTENT', tpl.render(template.Context()))
+        site_id = Site.objects.get_current().pk
+        cache.delete(caching.block_key(site_id, 'block',
+                                       caching.get_generation(site_id)))
+        with self.assertNumQueries(0):
+            self.assertEqual(u'CONTENT', tpl.render(template.Context()))
+
+    def testSaveInvalidatesLocalCache(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "block" 60 %}')
+        tpl.render(template.Context())
+        block = FlatBlock.objects.get(slug='block')
+        block.content = 'UPDATED'
+        block.save()
+        self.assertEqual(u'UPDATED', tpl.render(template.Context()))
+
+    def testDeleteInvalidatesLocalCache(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "block" 60 %}')
+        tpl.render(template.Context())
+        FlatBlock.objects.get(slug='block').delete()
+        self.assertEqual(u'', tpl.render(template.Context()))
+
+    def testVersionCheckedOncePerInterval(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "block" 60 %}')
+        tpl.render(template.Context())
+        old_check_interval = caching.local_cache.check_interval
+        caching.local_cache.check_interval = 60
+        counting = caching.cache = CountingCache(cache)
+        reads = []
+
+        def get(key, *args, **kwargs):
+            if key == caching.VERSION_KEY:
+                reads.append(key)
+            return cache.get(key, *args, **kwargs)
+        counting.get = get
+        try:
+            for i in range(2):
+                with caching.request_memo():
+                    self.assertEqual(u'CONTENT',
+                                     tpl.render(template.Context()))
+        finally:
+            caching.cache = cache
+            caching.local_cache.check_interval = old_check_interval
+        self.assertTrue(len(reads) <= 1, reads)
+
+    def testChangeDuringRequest(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "block" 60 %}')
+        with caching.request_memo() as memo:
+            tpl.render(template.Context())
+            self.assertTrue(memo.pending)
+            caching.bump_version()
+            self.assertTrue(memo.changed())
+
+
+class RenderedCacheTests(TestCase):
+    def setUp(self):
+        self.old_CACHE_RENDERED = settings.CACHE_RENDERED
+        self.old_CACHE_RENDERED_VARY_ON = settings.CACHE_RENDERED_VARY_ON
+        settings.CACHE_RENDERED = True
+        self.site = Site.objects.get_current()
+        self.block = FlatBlock.objects.create(slug='block', header='HEADER',
+                                              content='CONTENT', site=self.site)
+        cache.clear()
+
+    def tearDown(self):
+        settings.CACHE_RENDERED = self.old_CACHE_RENDERED
+        settings.CACHE_RENDERED_VARY_ON = self.old_CACHE_RENDERED_VARY_ON
+
+    @property
+    def generation(self):
+        return caching.get_generation(self.site.pk)
+
+    def fragment_key(self, vary_on=(), only=False):
+        return caching.fragment_key(self.site.pk, 'block', self.generation,
+                                    'flatblocks/flatblock.html', vary_on,
+                                    only)
+
+    def testFragmentIsCached(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% flatblock "block" 60 %}')
+        expected = tpl.render(template.Context())
+        key = self.fragment_key()
+        self.assertEqual(expected,
+                         caching.get_fragment(key, self.site.pk, 'block')[0])
+        # Remove the cached model instance: a hit must not need it
+        cache.delete(caching.block_key(self.site.pk, 'block', self.generation))
+        with self.assertNumQueries(0):
+            self.assertEqual(expected, tpl.render(template.Context()))
+
+    def testSaveInvalidatesFragment(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% flatblock "block" 60 %}')
+        tpl.render(template.Context())
+        self.block.header = 'UPDATED'
+        self.block.save()
+        self.assertTrue('UPDATED' in tpl.render(template.Context()))
+
+    def testSaveWhileRendering(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% flatblock "block" 60 %}')
+        key = self.fragment_key()
+        # A rendering looks the fragment up, the block is saved, and the
+        # fragment rendered from the old block is stored afterwards
+        output, version = caching.get_fragment(key, self.site.pk, 'block')
+        self.block.header = 'UPDATED'
+        self.block.save()
+        caching.set_fragment(key, version, 'OLDF', 60)
+        self.assertFalse('OLDF' in tpl.render(template.Context()))
+
+    def testSaveWhileWarming(self):
+        key = self.fragment_key()
+        versions = caching.get_block_versions([(self.site.pk, 'block')])
+        self.block.save()
+        caching.set_fragments([(key, versions[(self.site.pk, 'block')],
+                                'OLDF')], 60)
+        self.assertEqual(None,
+                         caching.get_fragment(key, self.site.pk, 'block')[0])
+
+    def testCreatedVersionIsRemembered(self):
+        key = self.fragment_key()
+        cache.clear()
+        counting = caching.cache = CountingCache(cache)
+        try:
+            with caching.request_memo():
+                version = caching.get_fragment(key, self.site.pk, 'block')[1]
+                counting.calls.clear()
+                self.assertEqual((None, version), caching.get_fragment(
+                    key, self.site.pk, 'block'))
+        finally:
+            caching.cache = cache
+        self.assertEqual({}, counting.calls)
+
+    def testNotCachedWithoutTimeout(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% flatblock "block" %}')
+        tpl.render(template.Context())
+        key = self.fragment_key()
+        self.assertEqual(None, caching.get_fragment(key, self.site.pk, 'block')[0])
+
+    def testVaryOn(self):
+        settings.CACHE_RENDERED_VARY_ON = {
+            'flatblocks/flatblock.html': ['lang'],
+        }
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% flatblock "block" 60 %}')
+        tpl.render(template.Context({'lang': 'en'}))
+        en_key = self.fragment_key(['en'])
+        de_key = self.fragment_key(['de'])
+        self.assertNotEqual(None,
+                            caching.get_fragment(en_key, self.site.pk, 'block')[0])
+        self.assertEqual(None,
+                         caching.get_fragment(de_key, self.site.pk, 'block')[0])
+
+    def testOnly(self):
+        settings.CACHE_RENDERED_VARY_ON = {
+            'flatblocks/flatblock.html': ['lang'],
+        }
+        tpl = template.Template('{% load flatblock_tags %}'
+            '{% flatblock "block" 60 using "flatblocks/flatblock.html" '
+            'only %}')
+        tpl.render(template.Context({'lang': 'en'}))
+        # The fragment isn't shared with the tag rendered in the full
+        # context, and doesn't vary on variables it can't see
+        self.assertEqual(None, caching.get_fragment(
+            self.fragment_key(['en']), self.site.pk, 'block')[0])
+        self.assertNotEqual(None, caching.get_fragment(
+            self.fragment_key(only=True), self.site.pk, 'block')[0])
+
+
+class InvalidationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='other.example.com',
+                                              name='other')
+        FlatBlock.objects.create(slug='block', content='CONTENT',
+                                 site=self.site)
+        FlatBlock.objects.create(slug='block', content='OTHER',
+                                 site=self.other_site)
+        self.tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "block" 60 %}')
+
+    def is_cached(self, site):
+        return cache.get(caching.block_key(
+            site.pk, 'block', caching.get_generation(site.pk))) is not None
+
+    def testKeysAreSiteAware(self):
+        self.assertNotEqual(
+            caching.block_key(self.site.pk, 'block', 'gen'),
+            caching.block_key(self.other_site.pk, 'block', 'gen'))
+
+    def testDelete(self):
+        self.assertEqual(u'CONTENT', self.tpl.render(template.Context()))
+        self.assertTrue(self.is_cached(self.site))
+        FlatBlock.objects.filter(site=self.site).delete()
+        self.assertFalse(self.is_cached(self.site))
+        self.assertEqual(u'', self.tpl.render(template.Context()))
+
+    def testRename(self):
+        self.assertEqual(u'CONTENT', self.tpl.render(template.Context()))
+        block = FlatBlock.objects.get(slug='block', site=self.site)
+        block.slug = 'renamed'
+        block.content = 'RENAMED'
+        block.save()
+        self.assertEqual(u'', self.tpl.render(template.Context()))
+
+    def testMoveToOtherSite(self):
+        FlatBlock.objects.filter(site=self.other_site).delete()
+        self.assertEqual(u'CONTENT', self.tpl.render(template.Context()))
+        block = FlatBlock.objects.get(slug='block', site=self.site)
+        block.site = self.other_site
+        block.save()
+        self.assertFalse(self.is_cached(self.site))
+        self.assertEqual(u'', self.tpl.render(template.Context()))
+
+    def testQuerySetUpdate(self):
+        self.assertEqual(u'CONTENT', self.tpl.render(template.Context()))
+        FlatBlock.objects.filter(site=self.site).update(content='UPDATED')
+        self.assertEqual(u'UPDATED', self.tpl.render(template.Context()))
+
+    def testInvalidateSite(self):
+        caching.set(caching.block_key(
+            self.other_site.pk, 'block',
+            caching.get_generation(self.other_site.pk)), 'x', 60)
+        self.tpl.render(template.Context())
+        caching.invalidate_site(self.site.pk)
+        self.assertFalse(self.is_cached(self.site))
+        self.assertTrue(self.is_cached(self.other_site))
+
+    def testInvalidateAll(self):
+        caching.set(caching.block_key(
+            self.other_site.pk, 'block',
+            caching.get_generation(self.other_site.pk)), 'x', 60)
+        self.tpl.render(template.Context())
+        caching.invalidate_all()
+        self.assertFalse(self.is_cached(self.site))
+        self.assertFalse(self.is_cached(self.other_site))
+
+
+class NegativeCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.old_NEGATIVE_CACHE_TIMEOUT = settings.NEGATIVE_CACHE_TIMEOUT
+        self.old_AUTOCREATE_STATIC_BLOCKS = settings.AUTOCREATE_STATIC_BLOCKS
+        settings.NEGATIVE_CACHE_TIMEOUT = 60
+        settings.AUTOCREATE_STATIC_BLOCKS = False
+        self.tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "missing" 60 %}')
+
+    def tearDown(self):
+        settings.NEGATIVE_CACHE_TIMEOUT = self.old_NEGATIVE_CACHE_TIMEOUT
+        settings.AUTOCREATE_STATIC_BLOCKS = self.old_AUTOCREATE_STATIC_BLOCKS
+
+    def testMissingBlockIsCached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(u'', self.tpl.render(template.Context()))
+        with self.assertNumQueries(0):
+            self.assertEqual(u'', self.tpl.render(template.Context()))
+
+    def testDefaultContentOnCachedMiss(self):
+        tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "missing" 60 '
+            'with-default %}DEFAULT{% end_plain_flatblock %}')
+        self.assertEqual(u'DEFAULT', tpl.render(template.Context()))
+        with self.assertNumQueries(0):
+            self.assertEqual(u'DEFAULT', tpl.render(template.Context()))
+
+    def testCreationClearsMarker(self):
+        self.tpl.render(template.Context())
+        FlatBlock.objects.create(slug='missing', content='CREATED',
+                                 site=self.site)
+        self.assertEqual(u'CREATED', self.tpl.render(template.Context()))
+
+    def testDisabled(self):
+        settings.NEGATIVE_CACHE_TIMEOUT = 0
+        self.tpl.render(template.Context())
+        with self.assertNumQueries(1):
+            self.tpl.render(template.Context())
+
+    def testAutocreateIgnoresMarker(self):
+        self.tpl.render(template.Context())
+        settings.AUTOCREATE_STATIC_BLOCKS = True
+        self.assertEqual(u'missing', self.tpl.render(template.Context()))
+        self.assertEqual(1, FlatBlock.objects.filter(slug='missing').count())
+
+
+class LazyDefaultTests(TestCase):
+    class Counter(object):
+        calls = 0
+
+        def tick(self):
+            self.calls += 1
+            return 'DEFAULT'
+
+    def setUp(self):
+        FlatBlock.objects.create(slug='block', content='CONTENT',
+                                 site=Site.objects.get_current())
+        self.old_AUTOCREATE_STATIC_BLOCKS = settings.AUTOCREATE_STATIC_BLOCKS
+        settings.AUTOCREATE_STATIC_BLOCKS = False
+
+    def tearDown(self):
+        settings.AUTOCREATE_STATIC_BLOCKS = self.old_AUTOCREATE_STATIC_BLOCKS
+
+    def render(self, slug):
+        counter = self.Counter()
+        tpl = template.Template('{% load flatblock_tags %}{% plain_flatblock '
+                                'name with-default header.tick %}'
+                                '{{ counter.tick }}{% end_plain_flatblock %}')
+        output = tpl.render(template.Context({
+            'name': slug, 'counter': counter, 'header': counter}))
+        return output, counter.calls
+
+    def testExistingBlockSkipsDefaults(self):
+        self.assertEqual((u'CONTENT', 0), self.render('block'))
+
+    def testMissingBlockRendersDefaults(self):
+        self.assertEqual((u'DEFAULT', 2), self.render('missing'))
+
+
+class CountingCache(object):
+    """
+    Wraps a cache backend and counts the calls of each of its methods.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class RequestMemoTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        for slug in ('block1', 'block2', 'block3'):
+            FlatBlock.objects.create(slug=slug, content=slug, site=self.site)
+        self.tpl = template.Template(
+            '{% load flatblock_tags %}'
+            '{% plain_flatblock "block1" 60 %}'
+            '{% plain_flatblock "block2" 60 %}'
+            '{% plain_flatblock "block3" 60 %}'
+            '{% plain_flatblock "block1" 60 %}')
+        self.counting = caching.cache = CountingCache(cache)
+
+    def tearDown(self):
+        caching.cache = cache
+
+    def testWarmCacheUsesGetMany(self):
+        self.tpl.render(template.Context())
+        self.counting.calls.clear()
+        with caching.request_memo():
+            self.assertEqual(u'block1block2block3block1',
+                             self.tpl.render(template.Context()))
+        self.assertEqual(0, self.counting.calls.get('get', 0))
+        # One call for the generation tokens, one for the blocks
+        self.assertEqual(2, self.counting.calls['get_many'])
+
+    def testCreatedTokensAreRemembered(self):
+        cache.clear()
+        with caching.request_memo():
+            generation = caching.get_generation(self.site.pk)
+            self.counting.calls.clear()
+            self.assertEqual(generation, caching.get_generation(self.site.pk))
+        self.assertEqual({}, self.counting.calls)
+
+    def testWritesAreBatched(self):
+        with caching.request_memo():
+            self.tpl.render(template.Context())
+            self.assertEqual(0, self.counting.calls.get('set', 0))
+            self.assertEqual(0, self.counting.calls.get('set_many', 0))
+        self.assertEqual(1, self.counting.calls['set_many'])
+        with self.assertNumQueries(0):
+            self.tpl.render(template.Context())
+
+    def testChangeDuringRequest(self):
+        import threading
+        from django.db.models.query import QuerySet
+        with caching.request_memo():
+            self.assertEqual(u'block1block2block3block1',
+                             self.tpl.render(template.Context()))
+            # Another worker changes a block before this request ends (the
+            # test database can't be shared with another thread)
+            QuerySet(FlatBlock).filter(slug='block1').update(content='NEW')
+            thread = threading.Thread(target=caching.invalidate_block,
+                                      args=(self.site.pk, 'block1'))
+            thread.start()
+            thread.join()
+        self.assertEqual(u'NEWblock2block3NEW',
+                         self.tpl.render(template.Context()))
+
+    def testMiddleware(self):
+        from flatblocks.middleware import FlatBlockMemoMiddleware
+        middleware = FlatBlockMemoMiddleware()
+        middleware.process_request(None)
+        self.assertNotEqual(None, caching.get_memo())
+        self.tpl.render(template.Context())
+        self.assertEqual(0, self.counting.calls.get('set_many', 0))
+        middleware.process_response(None, None)
+        self.assertEqual(None, caching.get_memo())
+        self.assertEqual(1, self.counting.calls['set_many'])
+
+
+class FlatBlocksTagTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        for slug in ('block1', 'block2', 'block3'):
+            FlatBlock.objects.create(slug=slug, header=slug.upper(),
+                                     content=slug, site=self.site)
+        self.old_AUTOCREATE_STATIC_BLOCKS = settings.AUTOCREATE_STATIC_BLOCKS
+        settings.AUTOCREATE_STATIC_BLOCKS = False
+
+    def tearDown(self):
+        settings.AUTOCREATE_STATIC_BLOCKS = self.old_AUTOCREATE_STATIC_BLOCKS
+
+    def render(self, source, **context):
+        return template.Template(
+            '{% load flatblock_tags %}' + source).render(
+                template.Context(context))
+
+    def testVariableList(self):
+        source = ('{% flatblocks slugs as blocks %}'
+                  '{% for block in blocks.values %}'
+                  '{{ block.content }},{% endfor %}')
+        with self.assertNumQueries(1):
+            self.assertEqual(u'block3,block1,', self.render(
+                source, slugs=['block3', 'missing', 'block1', 'block3']))
+
+    def testDictAccess(self):
+        source = '{% flatblocks "block1" name as blocks %}{{ blocks.block2 }}'
+        self.assertEqual(u'block2', self.render(source, name='block2'))
+
+    def testCached(self):
+        source = ('{% flatblocks slugs 60 as blocks %}'
+                  '{% for block in blocks.values %}'
+                  '{{ block.content }},{% endfor %}')
+        slugs = ['block1', 'block2', 'missing']
+        self.render(source, slugs=slugs)
+        with self.assertNumQueries(0):
+            self.assertEqual(u'block1,block2,',
+                             self.render(source, slugs=slugs))
+
+    def testDefaultContent(self):
+        source = ('{% flatblocks slugs as blocks with-default "HEADER" %}'
+                  'DEFAULT{% end_flatblocks %}'
+                  '{% for block in blocks.values %}'
+                  '{{ block.header }}:{{ block.content }},{% endfor %}')
+        self.assertEqual(u'BLOCK1:block1,HEADER:DEFAULT,', self.render(
+            source, slugs=['block1', 'missing']))
+
+    def testAutocreateStaticOnly(self):
+        settings.AUTOCREATE_STATIC_BLOCKS = True
+        self.render('{% flatblocks "new1" name as blocks %}', name='new2')
+        self.assertEqual(1, FlatBlock.objects.filter(slug='new1').count())
+        self.assertEqual(0, FlatBlock.objects.filter(slug='new2').count())
+
+    def testAutocreateCachedAbsence(self):
+        # A variable slug caches the absence of the block
+        self.render('{% plain_flatblock name 60 %}', name='auto')
+        settings.AUTOCREATE_STATIC_BLOCKS = True
+        self.assertEqual(u'auto', self.render(
+            '{% flatblocks "auto" 60 as blocks %}{{ blocks.auto.content }}'))
+        self.assertEqual(1, FlatBlock.objects.filter(slug='auto').count())
+
+    def testSyntax(self):
+        self.assertRaises(template.TemplateSyntaxError, template.Template,
+                          '{% load flatblock_tags %}{% flatblocks slugs %}')
+        self.assertRaises(template.TemplateSyntaxError, template.Template,
+                          '{% load flatblock_tags %}{% flatblocks as blocks %}')
+        self.assertRaises(template.TemplateSyntaxError, template.Template,
+                          '{% load flatblock_tags %}'
+                          '{% flatblocks 60 as blocks %}')
+        self.assertRaises(template.TemplateSyntaxError, template.Template,
+                          '{% load flatblock_tags %}'
+                          '{% flatblocks "block1" 60 "block2" as blocks %}')
+
+
+class StampedeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        FlatBlock.objects.create(slug='block', content='CONTENT',
+                                 site=self.site)
+        self.old_settings = (settings.STAMPEDE_PROTECTION,
+                             settings.STAMPEDE_WAIT,
+                             settings.CACHE_TIMEOUT_JITTER)
+        settings.STAMPEDE_PROTECTION = True
+        settings.STAMPEDE_WAIT = 0.2
+        self.tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "block" 60 %}')
+        self.key = caching.block_key(self.site.pk, 'block',
+                                     caching.get_generation(self.site.pk))
+
+    def tearDown(self):
+        (settings.STAMPEDE_PROTECTION, settings.STAMPEDE_WAIT,
+         settings.CACHE_TIMEOUT_JITTER) = self.old_settings
+
+    def testLockIsReleased(self):
+        self.assertEqual(u'CONTENT', self.tpl.render(template.Context()))
+        self.assertEqual(None, cache.get(caching.lock_key(self.key)))
+        self.assertNotEqual(None, cache.get(self.key))
+
+    def testWaitsForLockHolder(self):
+        import threading
+        self.assertTrue(caching.acquire_lock(self.key))
+        block = FlatBlock(slug='block', content='FROM OTHER PROCESS',
+                          site=self.site)
+        timer = threading.Timer(0.05, cache.set, (self.key, block, 60))
+        timer.start()
+        with self.assertNumQueries(0):
+            self.assertEqual(u'FROM OTHER PROCESS',
+                             self.tpl.render(template.Context()))
+        timer.join()
+
+    def testFallsBackAfterWaiting(self):
+        self.assertTrue(caching.acquire_lock(self.key))
+        with self.assertNumQueries(1):
+            self.assertEqual(u'CONTENT', self.tpl.render(template.Context()))
+
+    def testJitter(self):
+        settings.CACHE_TIMEOUT_JITTER = 0.1
+        timeouts = set(caching.jitter(100) for i in range(200))
+        self.assertTrue(len(timeouts) > 1)
+        self.assertTrue(min(timeouts) >= 90 and max(timeouts) <= 110)
+        settings.CACHE_TIMEOUT_JITTER = 0
+        self.assertEqual(100, caching.jitter(100))
+
+
+class StaleWhileRevalidateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.block = FlatBlock.objects.create(slug='block', content='CONTENT',
+                                              site=self.site)
+        self.old_STALE_WHILE_REVALIDATE = settings.STALE_WHILE_REVALIDATE
+        settings.STALE_WHILE_REVALIDATE = True
+        # Refresh synchronously: test databases are not shared with threads
+        self.old_refresh_pool = caching.refresh_pool
+        caching.refresh_pool = caching.RefreshPool(0, 10)
+        self.tpl = template.Template(
+            '{% load flatblock_tags %}{% plain_flatblock "block" 60 %}')
+        self.key = caching.block_key(self.site.pk, 'block',
+                                     caching.get_generation(self.site.pk))
+
+    def tearDown(self):
+        settings.STALE_WHILE_REVALIDATE = self.old_STALE_WHILE_REVALIDATE
+        caching.refresh_pool = self.old_refresh_pool
+
+    def testEntriesAreWrapped(self):
+        self.tpl.render(template.Context())
+        entry = cache.get(self.key)
+        self.assertTrue(isinstance(entry, caching.StaleEntry))
+        self.assertFalse(entry.is_stale())
+        with self.assertNumQueries(0):
+            self.assertEqual(u'CONTENT', self.tpl.render(template.Context()))
+
+    def testStaleEntryIsServedAndRefreshed(self):
+        stale = FlatBlock(slug='block', content='STALE', site=self.site)
+        cache.set(self.key, caching.StaleEntry(stale, 0), 60)
+        self.assertEqual(u'STALE', self.tpl.render(template.Context()))
+        entry = cache.get(self.key)
+        self.assertFalse(entry.is_stale())
+        self.assertEqual(u'CONTENT', self.tpl.render(template.Context()))
+
+    def testRefreshOfDeletedBlock(self):
+        stale = FlatBlock(slug='block', content='STALE', site=self.site)
+        FlatBlock.objects.all().delete()
+        cache.set(self.key, caching.StaleEntry(stale, 0), 60)
+        self.assertEqual(u'STALE', self.tpl.render(template.Context()))
+        self.assertEqual(u'', self.tpl.render(template.Context()))
+
+    def testBlockSavedDuringRefresh(self):
+        from flatblocks.api import refresh_flatblock
+        manager = FlatBlock.objects
+        old_get = manager.get
+
+        def get(*args, **kwargs):
+            # An editor saves the block after it has been read
+            flatblock = old_get(*args, **kwargs)
+            FlatBlock.objects.filter(pk=flatblock.pk).update(content='NEW')
+            caching.invalidate_block(self.site.pk, 'block')
+            return flatblock
+        manager.get = get
+        try:
+            refresh_flatblock(self.key, self.site.pk, 'block', 60, False,
+                              False)
+        finally:
+            del manager.get
+        self.assertEqual(None, cache.get(self.key))
+        self.assertEqual(u'NEW', self.tpl.render(template.Context()))
+
+
+class RefreshPoolTests(TestCase):
+    def testDeduplication(self):
+        import threading
+        pool = caching.RefreshPool(1, 10)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def refresh(name):
+            started.set()
+            release.wait(5)
+            calls.append(name)
+
+        self.assertTrue(pool.submit('key', refresh, 'first'))
+        started.wait(5)
+        self.assertFalse(pool.submit('key', refresh, 'second'))
+        self.assertTrue(pool.submit('other', refresh, 'other'))
+        release.set()
+        pool.join()
+        self.assertEqual(['first', 'other'], calls)
+        self.assertTrue(pool.submit('key', refresh, 'third'))
+        pool.join()
+
+    def testFullQueue(self):
+        pool = caching.RefreshPool(1, 1)
+        pool.start = lambda: None  # no workers, the queue stays full
+        self.assertTrue(pool.submit('a', lambda: None))
+        self.assertFalse(pool.submit('b', lambda: None))
+        self.assertFalse('b' in pool.pending)
+
+
+class WarmFlatBlocksCommandTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        for slug in ('sidebar.one', 'sidebar.two', 'footer'):
+            FlatBlock.objects.create(slug=slug, header=slug.upper(),
+                                     content=slug, site=self.site)
+
+    def warm(self, *args, **options):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        options['stdout'] = StringIO()
+        call_command('warmflatblocks', *args, **options)
+        return options['stdout'].getvalue()
+
+    def is_cached(self, slug):
+        return cache.get(caching.block_key(
+            self.site.pk, slug, caching.get_generation(self.site.pk))) \
+            is not None
+
+    def testWarmAll(self):
+        output = self.warm(chunk_size=2)
+        self.assertTrue(output.startswith('Cached 3 flatblocks'), output)
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% plain_flatblock "sidebar.one" 60 %}'
+                                '{% plain_flatblock "footer" 60 %}')
+        with self.assertNumQueries(0):
+            self.assertEqual(u'sidebar.onefooter',
+                             tpl.render(template.Context()))
+
+    def testSlugPattern(self):
+        self.warm(slug='sidebar.*')
+        self.assertTrue(self.is_cached('sidebar.one'))
+        self.assertTrue(self.is_cached('sidebar.two'))
+        self.assertFalse(self.is_cached('footer'))
+
+    def testSite(self):
+        self.warm(sites=[self.site.domain])
+        self.assertTrue(self.is_cached('footer'))
+        from django.core.management.base import CommandError
+        from flatblocks.management.commands.warmflatblocks import Command
+        self.assertRaises(CommandError, Command().get_queryset,
+                          ['unknown'], None)
+
+    def testRenderFragments(self):
+        old_CACHE_RENDERED = settings.CACHE_RENDERED
+        settings.CACHE_RENDERED = True
+        try:
+            output = self.warm(templates=['flatblocks/flatblock.html'])
+            self.assertTrue('and 3 fragments' in output)
+            tpl = template.Template(
+                '{% load flatblock_tags %}{% flatblock "footer" 60 %}')
+            cache.delete(caching.block_key(
+                self.site.pk, 'footer', caching.get_generation(self.site.pk)))
+            with self.assertNumQueries(0):
+                self.assertTrue('FOOTER' in tpl.render(template.Context()))
+        finally:
+            settings.CACHE_RENDERED = old_CACHE_RENDERED
+
+    def testSiteBundle(self):
+        old_SITE_BUNDLE = settings.SITE_BUNDLE
+        settings.SITE_BUNDLE = True
+        try:
+            output = self.warm(slug='footer')
+            self.assertTrue('bundles of 1 sites' in output, output)
+            tpl = template.Template('{% load flatblock_tags %}'
+                                    '{% plain_flatblock "sidebar.one" 60 %}'
+                                    '{% plain_flatblock "missing" 60 %}')
+            with self.assertNumQueries(0):
+                self.assertEqual(u'sidebar.one',
+                                 tpl.render(template.Context()))
+        finally:
+            settings.SITE_BUNDLE = old_SITE_BUNDLE
+
+
+class CreateStaticFlatBlocksCommandTests(TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.template_dir = tempfile.mkdtemp()
+        for name, source in (
+                ('page.html', '{% load flatblock_tags %}'
+                    '{% flatblock "intro" %}{% flatblock slug_variable %}'
+                    '{% plain_flatblock "help" with-default "Help" %}'
+                    'Ask {{ name }}!{% end_plain_flatblock %}'),
+                ('list.html', '{% load flatblock_tags %}'
+                    '{% flatblocks "promo" more 60 as promos %}'),
+                ('broken.html', '{% load flatblock_tags %}{% flatblock "x" 1 2 3 4 %}')):
+            f = open(os.path.join(self.template_dir, name), 'w')
+            f.write(source)
+            f.close()
+        FlatBlock.objects.create(slug='intro', content='EXISTING',
+                                 site=self.site)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.template_dir)
+
+    def create(self, *args, **options):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        options['stdout'] = StringIO()
+        call_command('createstaticflatblocks', self.template_dir, *args,
+                     **options)
+        return options['stdout'].getvalue()
+
+    def testCreateMissing(self):
+        caching.set(caching.block_key(self.site.pk, 'help',
+            caching.get_generation(self.site.pk)), caching.MISSING, 60)
+        with self.assertNumQueries(2):
+            output = self.create()
+        self.assertEqual('Created 2 of 3 flatblocks for %s\n'
+                         % self.site.domain, output)
+        help = FlatBlock.objects.get(slug='help', site=self.site)
+        self.assertEqual('Help', help.header)
+        self.assertEqual('Ask !', help.content)
+        self.assertEqual('promo', FlatBlock.objects.get(slug='promo').content)
+        self.assertEqual('EXISTING',
+                         FlatBlock.objects.get(slug='intro').content)
+        # Cached absences are dropped
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% plain_flatblock "help" 60 %}')
+        self.assertEqual('Ask !', tpl.render(template.Context()))
+        self.assertTrue(self.create().startswith('Created 0 of 3'))
+
+    def testDryRun(self):
+        output = self.create(dry_run=True)
+        self.assertTrue('%s: help\n' % self.site.domain in output)
+        self.assertTrue('Would create 2 of 3' in output)
+        self.assertEqual(1, FlatBlock.objects.count())
+
+    def testTemplateDirs(self):
+        import os
+        from flatblocks.management.commands.createstaticflatblocks import \
+            get_template_dirs, CACHED_LOADER, FILESYSTEM_LOADER
+        dirs = get_template_dirs([(CACHED_LOADER, (FILESYSTEM_LOADER,))])
+        self.assertTrue(dirs)
+        self.assertTrue(os.path.join('test_project', 'templates') in dirs[0])
+
+    def testRenderError(self):
+        import os
+        from StringIO import StringIO
+        f = open(os.path.join(self.template_dir, 'url.html'), 'w')
+        f.write('{% load flatblock_tags %}'
+                '{% flatblock "linked" with-default %}'
+                '{% url no_such_view %}{% end_flatblock %}'
+                '{% flatblock "other" %}')
+        f.close()
+        stderr = StringIO()
+        output = self.create(stderr=stderr)
+        self.assertTrue('Created 3 of 4' in output, output)
+        self.assertTrue('Skipping linked in ' in stderr.getvalue())
+        self.assertFalse(FlatBlock.objects.filter(slug='linked').exists())
+        self.assertTrue(FlatBlock.objects.filter(slug='other').exists())
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        from flatblocks.writebehind import write_queue
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.queue = write_queue
+        self.old_interval = write_queue.interval
+        write_queue.interval = 0
+        self.old_settings = (settings.WRITE_BEHIND,
+                             settings.AUTOCREATE_STATIC_BLOCKS,
+                             settings.STRICT_DEFAULT_CHECK,
+                             settings.STRICT_DEFAULT_CHECK_UPDATE)
+        settings.WRITE_BEHIND = True
+        settings.AUTOCREATE_STATIC_BLOCKS = True
+        settings.STRICT_DEFAULT_CHECK = True
+        settings.STRICT_DEFAULT_CHECK_UPDATE = True
+
+    def tearDown(self):
+        self.queue.interval = self.old_interval
+        self.queue.creates, self.queue.updates = {}, {}
+        (settings.WRITE_BEHIND, settings.AUTOCREATE_STATIC_BLOCKS,
+         settings.STRICT_DEFAULT_CHECK,
+         settings.STRICT_DEFAULT_CHECK_UPDATE) = self.old_settings
+
+    def testAutocreate(self):
+        tpl = template.Template('{% load flatblock_tags %}'
+            '{% plain_flatblock "new1" 60 %}'
+            '{% plain_flatblock "new2" 60 with-default %}NEW{% end_plain_flatblock %}')
+        with self.assertNumQueries(1):
+            self.assertEqual(u'new1NEW', tpl.render(template.Context()))
+        self.assertEqual(2, len(self.queue))
+        self.assertEqual(0, FlatBlock.objects.count())
+        # One query for the existing blocks, one for the insert
+        with self.assertNumQueries(2):
+            self.queue.flush()
+        self.assertEqual(0, len(self.queue))
+        self.assertEqual(u'NEW', FlatBlock.objects.get(slug='new2').content)
+        # The cached unsaved instances have been replaced
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% flatblock "new1" 60 %}')
+        self.assertTrue(u'new1' in tpl.render(template.Context()))
+        flatblock = caching.decode_block(caching.get(caching.block_key(
+            self.site.pk, 'new1', caching.get_generation(self.site.pk))))
+        self.assertTrue(flatblock.pk)
+
+    def testAlreadyCreated(self):
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% plain_flatblock "new" %}')
+        tpl.render(template.Context())
+        FlatBlock.objects.create(slug='new', content='OTHER', site=self.site)
+        self.queue.flush()
+        self.assertEqual(u'OTHER', FlatBlock.objects.get(slug='new').content)
+
+    def testStrictDefaultUpdate(self):
+        one = FlatBlock.objects.create(slug='one', site=self.site)
+        two = FlatBlock.objects.create(slug='two', content='TWO',
+                                       site=self.site)
+        tpl = template.Template('{% load flatblock_tags %}'
+            '{% plain_flatblock "one" with-default "H1" %}ONE{% end_plain_flatblock %}'
+            '{% plain_flatblock "two" with-default "H2" %}{% end_plain_flatblock %}')
+        self.assertEqual(u'ONETWO', tpl.render(template.Context()))
+        self.assertEqual(None, FlatBlock.objects.get(pk=one.pk).header)
+        with self.assertNumQueries(1):
+            self.queue.flush()
+        one = FlatBlock.objects.get(pk=one.pk)
+        self.assertEqual((u'H1', u'ONE'), (one.header, one.content))
+        two = FlatBlock.objects.get(pk=two.pk)
+        self.assertEqual((u'H2', u'TWO'), (two.header, two.content))
+
+    def testEditBeforeFlush(self):
+        FlatBlock.objects.create(slug='one', site=self.site)
+        tpl = template.Template('{% load flatblock_tags %}'
+            '{% plain_flatblock "one" with-default "H1" %}DEFAULT'
+            '{% end_plain_flatblock %}')
+        self.assertEqual(u'DEFAULT', tpl.render(template.Context()))
+        # An editor fills the content before the queue is written
+        one = FlatBlock.objects.get(slug='one')
+        one.content = 'EDITOR'
+        one.save()
+        self.queue.flush()
+        one = FlatBlock.objects.get(slug='one')
+        self.assertEqual((u'H1', u'EDITOR'), (one.header, one.content))
+
+    def testMiddleware(self):
+        from django.http import HttpResponse
+        from flatblocks.middleware import FlatBlockWriteBehindMiddleware
+        template.Template('{% load flatblock_tags %}'
+            '{% plain_flatblock "new" %}').render(template.Context())
+        FlatBlockWriteBehindMiddleware().process_response(None,
+                                                          HttpResponse())
+        self.assertEqual(0, len(self.queue))
+        self.assertTrue(FlatBlock.objects.filter(slug='new').exists())
+
+    def testFlushInManagedTransaction(self):
+        from django.db import transaction
+        FlatBlock.objects.create(slug='one', site=self.site)
+        template.Template('{% load flatblock_tags %}'
+            '{% plain_flatblock "new" %}'
+            '{% plain_flatblock "one" with-default %}ONE'
+            '{% end_plain_flatblock %}').render(template.Context())
+        # The test case runs in a managed transaction, like a request under
+        # TransactionMiddleware, which the flush must not end
+        self.assertTrue(transaction.is_managed())
+        calls = []
+        old_commit, old_rollback = transaction.commit, transaction.rollback
+        transaction.commit = lambda *args, **kwargs: calls.append('commit')
+        transaction.rollback = lambda *args, **kwargs: \
+            calls.append('rollback')
+        try:
+            self.queue.flush()
+        finally:
+            transaction.commit, transaction.rollback = old_commit, old_rollback
+        self.assertEqual([], calls)
+        self.assertTrue(FlatBlock.objects.filter(slug='new').exists())
+        self.assertEqual(u'ONE', FlatBlock.objects.get(slug='one').content)
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        for slug in ('one', 'two'):
+            FlatBlock.objects.create(slug=slug, content=slug.upper(),
+                                     site=self.site)
+
+    def testGetBlock(self):
+        import flatblocks
+        self.assertEqual(u'ONE', flatblocks.get_block('one').content)
+        with self.assertNumQueries(0):
+            self.assertEqual(u'ONE', flatblocks.get_block('one').content)
+        self.assertEqual(None, flatblocks.get_block('unknown'))
+        self.assertEqual(u'one', flatblocks.get_block('one', timeout=0).slug)
+
+    def testGetBlocks(self):
+        import flatblocks
+        counting = CountingCache(caching.cache)
+        caching.cache = counting
+        try:
+            with self.assertNumQueries(1):
+                flatblocks_ = flatblocks.get_blocks(['two', 'one', 'unknown'])
+            self.assertEqual(['two', 'one'], flatblocks_.keys())
+            # One for the generation of the site, one for the blocks
+            self.assertEqual(2, counting.calls['get_many'])
+            with self.assertNumQueries(0):
+                flatblocks.get_blocks(['two', 'one', 'unknown'])
+        finally:
+            caching.cache = counting.backend
+
+    def testDefaults(self):
+        from flatblocks.api import Defaults, get_blocks
+        flatblocks_ = get_blocks(['one', 'new'], site=self.site, timeout=0,
+                                 defaults=Defaults('Header', 'Soon'))
+        self.assertEqual(u'Soon', flatblocks_['new'].content)
+        self.assertEqual(None, flatblocks_['new'].pk)
+        flatblocks_ = get_blocks(['new'], timeout=0, autocreate=True,
+                                 defaults=Defaults('Header', 'Soon'))
+        self.assertEqual(u'Header',
+                         FlatBlock.objects.get(slug='new').header)
+
+
+class CachePayloadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.flatblock = FlatBlock.objects.create(slug='block', header='H',
+            content=u'CONTENT \xe9' * 100, site=self.site)
+        self.old_COMPRESS_THRESHOLD = settings.COMPRESS_THRESHOLD
+
+    def tearDown(self):
+        settings.COMPRESS_THRESHOLD = self.old_COMPRESS_THRESHOLD
+
+    def testRoundTrip(self):
+        payload = caching.encode_block(self.flatblock)
+        self.assertEqual(tuple, type(payload))
+        flatblock = caching.decode_block(payload)
+        self.assertEqual((self.flatblock.pk, self.site.pk, 'block', 'H',
+                          self.flatblock.content),
+                         (flatblock.id, flatblock.site_id, flatblock.slug,
+                          flatblock.header, flatblock.content))
+        self.assertRaises(AttributeError, setattr, flatblock, 'content', '')
+        self.assertEqual(caching.MISSING,
+                         caching.decode_block(caching.MISSING))
+        # Payloads of other versions are cache misses
+        self.assertEqual(None, caching.decode_block(
+            (caching.PAYLOAD_VERSION + 1,) + payload[1:]))
+
+    def testCompression(self):
+        settings.COMPRESS_THRESHOLD = 500
+        payload = caching.encode_block(self.flatblock)
+        self.assertTrue(payload[1])
+        self.assertTrue(len(payload[-1]) < 100)
+        self.assertEqual(self.flatblock.content,
+                         caching.decode_block(payload).content)
+        self.flatblock.content = u'short'
+        self.assertEqual(u'short', caching.encode_block(self.flatblock)[-1])
+
+    def testTemplateTag(self):
+        settings.COMPRESS_THRESHOLD = 500
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% flatblock "block" 60 %}')
+        output = tpl.render(template.Context())
+        with self.assertNumQueries(0):
+            self.assertEqual(output, tpl.render(template.Context()))
+        self.assertTrue(self.flatblock.content in output)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        cache.clear()
+        self.site = Site.objects.get_current()
+        FlatBlock.objects.create(slug='block', header='HEADER',
+                                 content=u'CONTENT \xe9', site=self.site)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.old_settings = (settings.BACKEND, settings.SNAPSHOT_PATH)
+        settings.SNAPSHOT_PATH = self.path
+
+    def tearDown(self):
+        import os
+        settings.BACKEND, settings.SNAPSHOT_PATH = self.old_settings
+        os.remove(self.path)
+
+    def export(self):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        stdout = StringIO()
+        call_command('exportflatblocks', stdout=stdout)
+        return stdout.getvalue()
+
+    def testTemplateTag(self):
+        self.assertEqual('Exported 1 flatblocks to %s\n' % self.path,
+                         self.export())
+        settings.BACKEND = 'snapshot'
+        tpl = template.Template('{% load flatblock_tags %}'
+            '{% plain_flatblock "block" 60 %}'
+            '{% plain_flatblock "unknown" %}'
+            '{% plain_flatblock "other" with-default %}DEFAULT'
+            '{% end_plain_flatblock %}')
+        counting = CountingCache(caching.cache)
+        caching.cache = counting
+        # The site isn't loaded from the database either
+        Site.objects.clear_cache()
+        try:
+            with self.assertNumQueries(0):
+                self.assertEqual(u'CONTENT \xe9DEFAULT',
+                                 tpl.render(template.Context()))
+        finally:
+            caching.cache = counting.backend
+        self.assertEqual({}, counting.calls)
+        self.assertEqual(0, FlatBlock.objects.filter(slug='other').count())
+
+    def testRequestSite(self):
+        from django.http import HttpRequest
+        other = Site.objects.create(domain='other.example.com', name='other')
+        FlatBlock.objects.create(slug='block', content='OTHER', site=other)
+        self.export()
+        settings.BACKEND = 'snapshot'
+        request = HttpRequest()
+        request.site = other
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% plain_flatblock "block" %}')
+        with self.assertNumQueries(0):
+            self.assertEqual(u'OTHER', tpl.render(
+                template.Context({'request': request})))
+
+    def testSiteOption(self):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        other = Site.objects.create(domain='other.example.com', name='other')
+        FlatBlock.objects.create(slug='block', content='OTHER', site=other)
+        stdout = StringIO()
+        call_command('exportflatblocks', sites=['other.example.com',
+                                                str(self.site.pk)],
+                     stdout=stdout)
+        self.assertEqual('Exported 2 flatblocks to %s\n' % self.path,
+                         stdout.getvalue())
+        self.assertRaises(SystemExit, call_command, 'exportflatblocks',
+                          sites=['unknown.example.com'], stderr=StringIO())
+
+    def testReload(self):
+        from flatblocks.snapshot import Snapshot
+        self.export()
+        snapshot = Snapshot(self.path, 60)
+        self.assertEqual(u'HEADER', snapshot.get(self.site.pk, 'block').header)
+        FlatBlock.objects.create(slug='new', site=self.site)
+        self.export()
+        # Only checked every 60 seconds
+        self.assertEqual(None, snapshot.get(self.site.pk, 'new'))
+        snapshot.refresh(snapshot.checked + 60)
+        self.assertEqual(u'new', snapshot.get(self.site.pk, 'new').slug)
+
+
+class SiteBundleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        for slug in ('block1', 'block2', 'block3'):
+            FlatBlock.objects.create(slug=slug, content=slug.upper(),
+                                     site=self.site)
+        self.old_settings = (settings.SITE_BUNDLE,
+                             settings.SITE_BUNDLE_MAX_BYTES)
+        settings.SITE_BUNDLE = True
+        self.tpl = template.Template('{% load flatblock_tags %}'
+            '{% plain_flatblock "block1" 60 %}'
+            '{% plain_flatblock slug 60 %}'
+            '{% plain_flatblock "unknown" 60 %}')
+
+    def tearDown(self):
+        (settings.SITE_BUNDLE,
+         settings.SITE_BUNDLE_MAX_BYTES) = self.old_settings
+
+    def render(self, slug='block2'):
+        return self.tpl.render(template.Context({'slug': slug}))
+
+    def testSingleEntry(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(u'BLOCK1BLOCK2', self.render())
+        counting = CountingCache(caching.cache)
+        caching.cache = counting
+        try:
+            with self.assertNumQueries(0):
+                self.assertEqual(u'BLOCK1BLOCK3', self.render('block3'))
+        finally:
+            caching.cache = counting.backend
+        # The generation of the site, then the bundle and its token
+        self.assertEqual({'get_many': 2}, counting.calls)
+
+    def testInvalidation(self):
+        self.render()
+        FlatBlock.objects.filter(slug='block2').update(content='NEW2')
+        self.assertEqual(u'BLOCK1NEW2', self.render())
+        block = FlatBlock.objects.get(slug='block1')
+        block.content = 'NEW1'
+        block.save()
+        FlatBlock.objects.create(slug='unknown', content='NEW3',
+                                 site=self.site)
+        with self.assertNumQueries(1):
+            self.assertEqual(u'NEW1NEW2NEW3', self.render())
+
+    def testSaveWhileLoading(self):
+        # A bundle loaded before a save but stored after it must not be used
+        generation = caching.get_generation(self.site.pk)
+        records, token = caching.get_bundle(self.site.pk, generation)
+        records = dict((flatblock.slug, caching.encode_block(flatblock))
+                       for flatblock in FlatBlock.objects.all())
+        block = FlatBlock.objects.get(slug='block1')
+        block.content = 'NEW1'
+        block.save()
+        caching.set_bundle(self.site.pk, generation, token, records, 60)
+        self.assertEqual(u'NEW1BLOCK2', self.render())
+
+    def testTooLarge(self):
+        settings.SITE_BUNDLE_MAX_BYTES = 10
+        self.assertEqual(u'BLOCK1BLOCK2', self.render())
+        self.assertEqual(caching.TOO_LARGE, caching.get_bundle(
+            self.site.pk, caching.get_generation(self.site.pk))[0])
+        # Blocks are cached one by one
+        with self.assertNumQueries(0):
+            self.assertEqual(u'BLOCK1BLOCK2', self.render())
+
+    def testGetBlocks(self):
+        from flatblocks.api import Defaults, get_blocks
+        with self.assertNumQueries(1):
+            flatblocks_ = get_blocks(['block3', 'unknown', 'other'],
+                                     defaults=Defaults(content='DEFAULT'))
+        self.assertEqual([u'BLOCK3', u'DEFAULT', u'DEFAULT'],
+                         [flatblock.content
+                          for flatblock in flatblocks_.values()])
+
+
+class WrapperTemplateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        FlatBlock.objects.create(slug='block', content='CONTENT',
+                                 site=self.site)
+        from django.template import loader
+        self.loader = loader
+        self.old_get_template = loader.get_template
+        self.loaded = []
+        self.templates = {
+            'wrapper.html': '{{ flatblock.content }}|{{ name }}',
+        }
+
+        def get_template(name):
+            self.loaded.append(name)
+            return template.Template(self.templates[name])
+        loader.get_template = get_template
+
+    def tearDown(self):
+        self.loader.get_template = self.old_get_template
+
+    def testOuterContext(self):
+        tpl = template.Template('{% load flatblock_tags %}'
+            '{% flatblock "block" using "wrapper.html" %}'
+            '{% flatblock "block" using "wrapper.html" %}|{{ flatblock }}')
+        self.assertEqual(u'CONTENT|outerCONTENT|outer|',
+                         tpl.render(template.Context({'name': 'outer'})))
+        self.assertEqual(u'CONTENT|outerCONTENT|outer|',
+                         tpl.render(template.Context({'name': 'outer'})))
+        # Static template names are compiled once per tag
+        self.assertEqual(['wrapper.html'] * 2, self.loaded)
+
+    def testOnly(self):
+        tpl = template.Template('{% load flatblock_tags %}'
+            '{% flatblock "block" using "wrapper.html" only %}'
+            '{% flatblock "block" 60 only %}')
+        self.templates['flatblocks/flatblock.html'] = '[{{ flatblock }}]'
+        self.assertEqual(u'CONTENT|[block]',
+                         tpl.render(template.Context({'name': 'outer'})))
+
+    def testVariableTemplateName(self):
+        tpl = template.Template('{% load flatblock_tags %}'
+                                '{% flatblock "block" using tpl_name %}')
+        context = template.Context({'tpl_name': 'wrapper.html'})
+        tpl.render(context)
+        tpl.render(context)
+        self.assertEqual(['wrapper.html'] * 2, self.loaded)
+
+
+class SiteResolutionTests(TestCase):
+    def setUp(self):
+        from django.test.client import RequestFactory
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.other_site = Site.objects.create(domain='other.example.com',
+                                              name='other')
+        FlatBlock.objects.create(slug='block', content='DEFAULT',
+                                 site=self.site)
+        FlatBlock.objects.create(slug='block', content='OTHER',
+                                 site=self.other_site)
+        self.factory = RequestFactory()
+        self.old_SITE_FROM_HOST = settings.SITE_FROM_HOST
+        self.tpl = template.Template('{% load flatblock_tags %}'
+            '{% plain_flatblock "block" %}{% plain_flatblock "block" %}')
+
+    def tearDown(self):
+        from flatblocks.sites import clear_site_map
+        settings.SITE_FROM_HOST = self.old_SITE_FROM_HOST
+        clear_site_map(Site)
+
+    def render(self, request):
+        return self.tpl.render(template.Context({'request': request}))
+
+    def testRequestSite(self):
+        request = self.factory.get('/')
+        self.assertEqual(u'DEFAULTDEFAULT', self.render(request))
+        request.site = self.other_site
+        self.assertEqual(u'OTHEROTHER', self.render(request))
+
+    def testHost(self):
+        from flatblocks.sites import get_current_site
+        request = self.factory.get('/', HTTP_HOST='other.example.com:8000')
+        self.assertEqual(u'DEFAULTDEFAULT', self.render(request))
+        settings.SITE_FROM_HOST = True
+        self.assertEqual(u'OTHEROTHER', self.render(request))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.other_site, get_current_site(request))
+        # Unknown hosts fall back to SITE_ID
+        request = self.factory.get('/', HTTP_HOST='unknown.example.com')
+        self.assertEqual(self.site, get_current_site(request))
+        # The map is reloaded when sites change
+        self.other_site.domain = 'renamed.example.com'
+        self.other_site.save()
+        request = self.factory.get('/', HTTP_HOST='renamed.example.com')
+        self.assertEqual(self.other_site, get_current_site(request))
+
+
+class TagCompilationTests(TestCase):
+    def testStateless(self):
+        from flatblocks.templatetags import flatblock_tags
+        template.Template('{% load flatblock_tags %}'
+            '{% flatblock "block" 10 using "tpl.html" %}'
+            '{% plain_flatblock "other" with-default "H" %}'
+            'content{% end_plain_flatblock %}')
+        self.assertEqual({}, flatblock_tags.do_get_flatblock.__dict__)
+        self.assertEqual({}, flatblock_tags.do_plain_flatblock.__dict__)
+
+    def testParallelCompilation(self):
+        import threading
+        from flatblocks.templatetags.flatblock_tags import FlatBlockNode
+        results = {}
+
+        def compile(i):
+            nodes = template.Template(
+                '{%% load flatblock_tags %%}'
+                '{%% flatblock "block%d" %d using "tpl%d.html" %%}'
+                '{%% plain_flatblock "plain%d" with-default %%}%d'
+                '{%% end_plain_flatblock %%}' % (i, i, i, i, i)
+            ).nodelist.get_nodes_by_type(FlatBlockNode)
+            results[i] = [(node.slug, node.cache_time, node.template_name,
+                           node.default_content.render(template.Context())
+                           if node.default_content else None)
+                          for node in nodes]
+        threads = [threading.Thread(target=compile, args=(i,))
+                   for i in range(1, 21)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(1, 21):
+            self.assertEqual([
+                ('block%d' % i, i, 'tpl%d.html' % i, None),
+                ('plain%d' % i, 0, 'flatblocks/flatblock.html', str(i)),
+            ], results[i])
+
+    def testMissingSlug(self):
+        self.assertRaises(template.TemplateSyntaxError, template.Template,
+                          '{% load flatblock_tags %}{% flatblock %}')
+
+    def testOnlyWithoutTemplate(self):
+        self.assertRaises(template.TemplateSyntaxError, template.Template,
+                          '{% load flatblock_tags %}'
+                          '{% plain_flatblock "block" only %}')
+
+
+class MetricsTests(TestCase):
+    urls = 'flatblocks.urls'
+
+    def setUp(self):
+        from flatblocks import metrics
+        cache.clear()
+        self.site = Site.objects.get_current()
+        FlatBlock.objects.create(slug='block', content='CONTENT',
+                                 site=self.site)
+        self.old_METRICS = settings.METRICS
+        settings.METRICS = True
+        metrics.reset()
+        self.tpl = template.Template('{% load flatblock_tags %}'
+            '{% flatblock "block" 60 %}{% flatblock "unknown" 60 %}')
+
+    def tearDown(self):
+        settings.METRICS = self.old_METRICS
+
+    def values(self):
+        from flatblocks import metrics
+        return dict(((record['name'], record['slug']),
+                     record.get('value', record.get('count')))
+                    for record in metrics.snapshot())
+
+    def testCounters(self):
+        self.tpl.render(template.Context())
+        self.tpl.render(template.Context())
+        values = self.values()
+        self.assertEqual(1, values[('cache_miss', 'block')])
+        self.assertEqual(1, values[('db_lookup', 'block')])
+        self.assertEqual(1, values[('cache_hit', 'block')])
+        self.assertEqual(1, values[('negative_hit', 'unknown')])
+        self.assertEqual(2, values[('render', 'block')])
+
+    def testGetBlocks(self):
+        import flatblocks
+        flatblocks.get_blocks(['block', 'unknown'])
+        flatblocks.get_blocks(['block', 'unknown'])
+        values = self.values()
+        self.assertEqual(2, values[('db_lookup', 'block')] +
+                            values[('db_lookup', 'unknown')])
+        self.assertEqual(1, values[('negative_hit', 'unknown')])
+
+    def testDisabled(self):
+        settings.METRICS = False
+        self.tpl.render(template.Context())
+        self.assertEqual({}, self.values())
+
+    def testView(self):
+        import json
+        from django.contrib.auth.models import User
+        User.objects.create_superuser('admin', 'admin@localhost', 'pwd')
+        self.client.login(username='admin', password='pwd')
+        self.tpl.render(template.Context())
+        records = json.loads(self.client.get('/metrics/').content)
+        self.assertTrue({'name': 'db_lookup', 'site': self.site.pk,
+                         'slug': 'block', 'value': 1} in records)
+        self.client.post('/metrics/')
+        self.assertEqual([], json.loads(self.client.get('/metrics/').content))
+
+    def testHistogram(self):
+        from flatblocks.metrics import Histogram
+        histogram = Histogram()
+        for milliseconds in (0.5, 3, 3000):
+            histogram.add(milliseconds)
+        data = histogram.as_dict()
+        self.assertEqual((3, 0.5, 3000), (data['count'], data['min_ms'],
+                                          data['max_ms']))
+        self.assertEqual((1, 1, 1), (data['buckets']['le_1'],
+            data['buckets']['le_5'], data['buckets']['inf']))
+
+
+class ProfilerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        FlatBlock.objects.create(slug='block', content='CONTENT',
+                                 site=self.site)
+        FlatBlock.objects.create(slug='other', content='OTHER',
+                                 site=self.site)
+
+    def render(self, source):
+        tpl = template.Template('{% load flatblock_tags %}' + source)
+        return tpl.render(template.Context())
+
+    def testLookups(self):
+        from flatblocks.profiler import profile_flatblocks
+        self.render('{% flatblock "block" 60 %}')
+        with profile_flatblocks() as profile:
+            self.render('{% flatblock "block" 60 %}{% flatblock "other" 60 %}'
+                        '{% flatblock "unknown" 60 %}')
+        self.assertEqual([('block', 'cache'), ('other', 'db'),
+                          ('unknown', 'db')],
+                         [(lookup.slug, lookup.source)
+                          for lookup in profile.lookups])
+        self.assertEqual(2, profile.db_lookups)
+        self.assertEqual([self.site.pk] * 3,
+                         [lookup.site_id for lookup in profile.lookups])
+        self.assertTrue(profile.lookups[1].db_time > 0)
+        self.assertTrue(profile.render_time > 0)
+
+    def testRepeatedLookups(self):
+        import warnings
+        from flatblocks.profiler import (profile_flatblocks,
+            FlatBlockProfilerWarning, FlatBlockProfilerError)
+        source = '{% flatblock "block" 0 %}{% flatblock "block" 0 %}'
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with profile_flatblocks():
+                self.render(source)
+        self.assertEqual(1, len(caught))
+        self.assertTrue(issubclass(caught[0].category,
+                                   FlatBlockProfilerWarning))
+        self.assertTrue("'block'" in str(caught[0].message))
+        def strict():
+            with profile_flatblocks(strict=True):
+                self.render(source)
+        self.assertRaises(FlatBlockProfilerError, strict)
+
+    def testMaxDbLookups(self):
+        from flatblocks.profiler import (profile_flatblocks,
+            FlatBlockProfilerError)
+        with profile_flatblocks(max_db_lookups=2, strict=True):
+            self.render('{% flatblock "block" 60 %}{% flatblock "other" 60 %}')
+        def strict():
+            with profile_flatblocks(max_db_lookups=1, strict=True):
+                self.render('{% flatblock "block" 0 %}'
+                            '{% flatblock "other" 0 %}')
+        self.assertRaises(FlatBlockProfilerError, strict)
+
+    def testNotRecordedOutside(self):
+        from flatblocks import metrics
+        from flatblocks.profiler import get_profile, profile_flatblocks
+        with profile_flatblocks() as profile:
+            pass
+        self.render('{% flatblock "block" 60 %}')
+        self.assertEqual([], profile.lookups)
+        self.assertEqual(None, get_profile())
+        self.assertFalse(metrics.has_listeners())
+
+    def testMiddleware(self):
+        from django.http import HttpRequest, HttpResponse
+        from flatblocks.middleware import FlatBlockProfilerMiddleware
+        middleware = FlatBlockProfilerMiddleware()
+        middleware.process_request(HttpRequest())
+        self.render('{% flatblock "block" 60 %}')
+        response = middleware.process_response(HttpRequest(), HttpResponse())
+        self.assertTrue(response['Server-Timing'].startswith(
+            'flatblocks;dur='))
+        self.assertTrue('1 lookups, 1 from db' in response['Server-Timing'])
+
+
+class QueryBudgetTests(TestCase):
+    """
+    The exact number of queries and cache operations of every configuration
+    of the flatblock tags, cold, warm and after the block was invalidated.
+    A change adding a query or a cache call to the hot path fails here.
+    """
+
+    # The generation tokens are fetched (get_many), the block is looked up
+    # (get), loaded with one query and cached (set)
+    COLD = (1, {'get_many': 1, 'get': 1, 'set': 1})
+    WARM = (0, {'get_many': 1, 'get': 1})
+    INVALIDATED = COLD
+
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        FlatBlock.objects.create(slug='block', header='HEADER',
+                                 content='CONTENT', site=self.site)
+        FlatBlock.objects.create(slug='empty', site=self.site)
+        self.old_settings = dict((name, getattr(settings, name)) for name in (
+            'AUTOCREATE_STATIC_BLOCKS', 'STRICT_DEFAULT_CHECK',
+            'STRICT_DEFAULT_CHECK_UPDATE'))
+        self.counting = caching.cache = CountingCache(caching.cache)
+
+    def tearDown(self):
+        caching.cache = self.counting.backend
+        for name, value in self.old_settings.items():
+            setattr(settings, name, value)
+
+    def count(self, func):
+        """
+        Returns the number of queries and the cache calls made by ``func``.
+        """
+        connection = db.connections['default']
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        started = len(connection.queries)
+        self.counting.calls.clear()
+        try:
+            func()
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        return len(connection.queries) - started, dict(self.counting.calls)
+
+    def assertBudget(self, source, cold, warm, invalidated, context=None,
+                     slug='block'):
+        """
+        ``cold``, ``warm`` and ``invalidated`` are the expected number of
+        queries and the expected cache calls, by method name, of rendering
+        ``source`` with an empty cache, again, and after ``slug`` was saved.
+        """
+        tpl = template.Template('{% load flatblock_tags %}' + source)
+        render = lambda: tpl.render(template.Context(context or {}))
+        phases = [('cold', cold), ('warm', warm)]
+        if invalidated is not None:
+            phases.append(('invalidated', invalidated))
+        for phase, expected in phases:
+            if phase == 'invalidated':
+                FlatBlock.objects.get(slug=slug, site=self.site).save()
+            counts = self.count(render)
+            self.assertEqual(expected, counts, '%s: %r != %r' % (
+                phase, expected, counts))
+
+    def testTimeout(self):
+        self.assertBudget('{% flatblock "block" 60 %}',
+                          self.COLD, self.WARM, self.INVALIDATED)
+
+    def testNoTimeout(self):
+        # Not cached at all
+        self.assertBudget('{% flatblock "block" %}', (1, {}), (1, {}), (1, {}))
+
+    def testNoneTimeout(self):
+        self.assertBudget('{% flatblock "block" None %}',
+                          self.COLD, self.WARM, self.INVALIDATED)
+
+    def testUsing(self):
+        self.assertBudget('{% flatblock "block" 60 using '
+                          '"flatblocks/flatblock.html" %}',
+                          self.COLD, self.WARM, self.INVALIDATED)
+
+    def testUsingOnly(self):
+        self.assertBudget('{% flatblock "block" 60 using '
+                          '"flatblocks/flatblock.html" only %}',
+                          self.COLD, self.WARM, self.INVALIDATED)
+
+    def testUsingVariable(self):
+        self.assertBudget('{% flatblock "block" 60 using tpl %}',
+                          self.COLD, self.WARM, self.INVALIDATED,
+                          context={'tpl': 'flatblocks/flatblock.html'})
+
+    def testVariableSlug(self):
+        self.assertBudget('{% flatblock slug 60 %}',
+                          self.COLD, self.WARM, self.INVALIDATED,
+                          context={'slug': 'block'})
+
+    def testWithDefault(self):
+        self.assertBudget('{% flatblock "block" 60 with-default %}'
+                          'DEFAULT{% end_flatblock %}',
+                          self.COLD, self.WARM, self.INVALIDATED)
+
+    def testWithDefaultHeader(self):
+        self.assertBudget('{% flatblock "block" 60 with-default "HEADER" %}'
+                          'DEFAULT{% end_flatblock %}',
+                          self.COLD, self.WARM, self.INVALIDATED)
+
+    def testPlain(self):
+        self.assertBudget('{% plain_flatblock "block" 60 %}',
+                          self.COLD, self.WARM, self.INVALIDATED)
+
+    def testPlainWithDefault(self):
+        self.assertBudget('{% plain_flatblock "block" 60 with-default '
+                          '"HEADER" %}DEFAULT{% end_plain_flatblock %}',
+                          self.COLD, self.WARM, self.INVALIDATED)
+
+    def testMissing(self):
+        # The absence of the block is cached like a block
+        self.assertBudget('{% flatblock "missing" 60 %}',
+                          self.COLD, self.WARM, None)
+
+    def testStaticSlugsShareQuery(self):
+        # Both static blocks are loaded with a single query
+        self.assertBudget('{% flatblock "block" 60 %}'
+                          '{% flatblock "empty" 60 %}',
+                          (1, {'get_many': 1, 'get': 2, 'set': 2}),
+                          (0, {'get_many': 1, 'get': 2}),
+                          (1, {'get_many': 1, 'get': 2, 'set': 1}))
+
+    def testAutocreate(self):
+        settings.AUTOCREATE_STATIC_BLOCKS = True
+        # get_or_create costs two queries, and saving the new block
+        # invalidates its cache entry (get_many, delete and two sets)
+        self.assertBudget('{% flatblock "new" 60 with-default "HEADER" %}'
+                          'DEFAULT{% end_flatblock %}',
+                          (3, {'get_many': 2, 'get': 1, 'delete': 1,
+                               'set': 3}),
+                          self.WARM, self.INVALIDATED, slug='new')
+
+    def testStrictDefaultCheck(self):
+        settings.STRICT_DEFAULT_CHECK = True
+        # The defaults are only applied to the cached copy
+        self.assertBudget('{% flatblock "empty" 60 with-default "HEADER" %}'
+                          'DEFAULT{% end_flatblock %}',
+                          self.COLD, self.WARM, self.INVALIDATED,
+                          slug='empty')
+
+    def testStrictDefaultCheckUpdate(self):
+        settings.STRICT_DEFAULT_CHECK = True
+        settings.STRICT_DEFAULT_CHECK_UPDATE = True
+        # Saving the defaults costs two queries and invalidates the block
+        self.assertBudget('{% flatblock "empty" 60 with-default "HEADER" %}'
+                          'DEFAULT{% end_flatblock %}',
+                          (3, {'get_many': 2, 'get': 1, 'delete': 1,
+                               'set': 3}),
+                          self.WARM, self.INVALIDATED, slug='empty')
@@ -1,8 +1,10 @@
 from django.conf.urls.defaults import patterns, url
 from django.contrib.admin.views.decorators import staff_member_required
-from flatblocks.views import edit
+from flatblocks.views import edit, metrics
 
 urlpatterns = patterns('',
     url('^edit/(?P<pk>\d+)/$', staff_member_required(edit),
-            name='flatblocks-edit')
+            name='flatblocks-edit'),
+    url('^metrics/$', staff_member_required(metrics),
+            name='flatblocks-metrics'),
 )
@@ -1,9 +1,15 @@
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.http import HttpResponseRedirect, HttpResponseForbidden,\
                         HttpResponse
 from django.utils.translation import ugettext as _
 
+from flatblocks import metrics as flatblock_metrics
 from flatblocks.models import FlatBlock
 from flatblocks.forms import FlatBlockForm
 
@@ -69,3 +75,17 @@ def edit(request, pk, modelform_class=FlatBlockForm, permission_check=None,
         'origin': origin,
         'flatblock': flatblock,
         }, context_instance=RequestContext(request))
+
+
+def metrics(request):
+    """
+    Returns the flatblock metrics collected by this process as JSON, see
+    ``flatblocks.metrics``. A POST request also resets them.
+
+    Like the edit view, this view doesn't check any permissions by itself.
+    """
+    records = flatblock_metrics.snapshot()
+    if request.method == 'POST':
+        flatblock_metrics.reset()
+    return HttpResponse(json.dumps(records, indent=2),
+                        content_type='application/json')
@@ -0,0 +1,189 @@
+"""
+Deferred database writes of the template tags.
+
+With ``FLATBLOCKS_WRITE_BEHIND`` the flatblocks created by
+``FLATBLOCKS_AUTOCREATE_STATIC_BLOCKS`` and the defaults stored by
+``FLATBLOCKS_STRICT_DEFAULT_CHECK_UPDATE`` aren't written while the page is
+rendered. The tag renders an unsaved instance right away and hands the write
+to ``write_queue``, which sends the pending writes in batches of at most
+``FLATBLOCKS_WRITE_BEHIND_BATCH_SIZE`` flatblocks: one ``bulk_create`` for
+the new blocks and one ``UPDATE`` statement for the changed ones.
+
+A background thread flushes the queue every
+``FLATBLOCKS_WRITE_BEHIND_INTERVAL`` seconds. With an interval of ``0`` there
+is no thread and the queue is flushed by ``FlatBlockWriteBehindMiddleware``
+at the end of each request (or by calling ``write_queue.flush()``). Whatever
+is still pending when the process exits is flushed too.
+
+The writes are committed on their own. When the queue is flushed inside a
+transaction managed by someone else, e.g. by ``TransactionMiddleware``, they
+are wrapped in a savepoint instead, so that they neither commit nor roll
+back the writes of the view.
+"""
+
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection, transaction, IntegrityError
+
+from flatblocks import caching, settings
+from flatblocks.models import FlatBlock
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def write_transaction():
+    """
+    Commits the writes made in the ``with`` block, or, within a managed
+    transaction, only releases a savepoint around them: Django's
+    ``commit_on_success`` would commit or roll back the whole outer
+    transaction.
+    """
+    if not transaction.is_managed():
+        with transaction.commit_on_success():
+            yield
+        return
+    sid = transaction.savepoint()
+    try:
+        yield
+    except:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+
+
+class WriteBehindQueue(object):
+    """
+    The pending creations, keyed by site id and slug, and the pending
+    header/content updates, keyed by primary key.
+    """
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.creates = {}
+        self.updates = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def __len__(self):
+        return len(self.creates) + len(self.updates)
+
+    def create(self, flatblock):
+        with self._lock:
+            self.creates.setdefault((flatblock.site_id, flatblock.slug),
+                                    flatblock)
+        self.start()
+
+    def update(self, flatblock):
+        with self._lock:
+            self.updates[flatblock.pk] = flatblock
+        self.start()
+
+    def start(self):
+        if not self.interval or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if not len(self):
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing the pending flatblocks failed")
+            finally:
+                # Don't keep a database connection open between flushes
+                connection.close()
+
+    def flush(self):
+        """
+        Writes all the pending changes.
+        """
+        with self._flush_lock:
+            with self._lock:
+                creates, self.creates = self.creates.values(), {}
+                updates, self.updates = self.updates.values(), {}
+            for start in range(0, len(creates), self.batch_size):
+                self.write_creates(creates[start:start + self.batch_size])
+            for start in range(0, len(updates), self.batch_size):
+                self.write_updates(updates[start:start + self.batch_size])
+
+    def write_creates(self, flatblocks):
+        site_ids = set(flatblock.site_id for flatblock in flatblocks)
+        slugs = set(flatblock.slug for flatblock in flatblocks)
+        existing = set(FlatBlock.objects.filter(site__in=site_ids,
+            slug__in=slugs).values_list('site', 'slug'))
+        flatblocks = [flatblock for flatblock in flatblocks
+                      if (flatblock.site_id, flatblock.slug) not in existing]
+        if not flatblocks:
+            return
+        try:
+            with write_transaction():
+                FlatBlock.objects.bulk_create(flatblocks)
+        except IntegrityError:
+            # Another process created some of them in the meantime
+            for flatblock in flatblocks:
+                FlatBlock.objects.get_or_create(slug=flatblock.slug,
+                    site=flatblock.site_id, defaults={
+                        'header': flatblock.header,
+                        'content': flatblock.content,
+                    })
+        # bulk_create() sends no signals, and the unsaved instances have
+        # been cached in the meantime
+        for flatblock in flatblocks:
+            caching.invalidate_block(flatblock.site_id, flatblock.slug)
+
+    def write_updates(self, flatblocks):
+        qn = connection.ops.quote_name
+        table = qn(FlatBlock._meta.db_table)
+        pk_column = qn(FlatBlock._meta.pk.column)
+        assignments, params = [], []
+        for name in ('header', 'content'):
+            column = qn(FlatBlock._meta.get_field(name).column)
+            # Strict default updates only fill empty fields, so a value
+            # saved since the flatblock was rendered is kept
+            case = "WHEN %%s THEN CASE WHEN %s IS NULL OR %s = '' " \
+                   "THEN %%s ELSE %s END" % (column, column, column)
+            cases = []
+            for flatblock in flatblocks:
+                cases.append(case)
+                params.extend([flatblock.pk, getattr(flatblock, name)])
+            assignments.append('%s = CASE %s %s ELSE %s END' % (
+                column, pk_column, ' '.join(cases), column))
+        params.extend(flatblock.pk for flatblock in flatblocks)
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+            table, ', '.join(assignments), pk_column,
+            ', '.join(['%s'] * len(flatblocks)))
+        with write_transaction():
+            connection.cursor().execute(sql, params)
+            transaction.set_dirty()
+        for flatblock in flatblocks:
+            caching.invalidate_block(flatblock.site_id, flatblock.slug)
+
+
+write_queue = WriteBehindQueue(settings.WRITE_BEHIND_INTERVAL,
+                               settings.WRITE_BEHIND_BATCH_SIZE)
+
+
+def _flush_at_exit():
+    if not len(write_queue):
+        return
+    try:
+        write_queue.flush()
+    except Exception:
+        logger.exception("Writing the pending flatblocks failed")
+
+atexit.register(_flush_at_exit)
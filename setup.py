@@ -22,6 +22,7 @@ setup(
     author = u'Armando Pérez (Horst Gutmann)',
     # author_email = 'zerok@zerokspot.com',
     url = 'http://github.com/mandx/django-flatblocks/',
+    install_requires = ['Django>=1.4'],
     dependency_links = [],
     classifiers = [
         'Development Status :: 3 - Alpha',
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the flatblock template tags.
+
+Renders templates using ``{% flatblock %}`` and ``{% plain_flatblock %}`` in
+various configurations against the settings of this test project, with an
+in-memory sqlite database and a locmem or file based cache, and writes the
+throughput and latency of every benchmark as JSON::
+
+    python benchmarks.py --output before.json
+    # change something
+    python benchmarks.py --output after.json --compare before.json
+
+Every benchmark is run ``cold`` (the cache is cleared before each rendering,
+so every block comes from the database) and ``warm`` (everything is cached).
+Pass benchmark names, or prefixes of them like ``plain_flatblock/``, to run
+only some of them.
+"""
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from optparse import OptionParser
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+
+def get_options(argv):
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-c', '--cache', choices=('locmem', 'file'),
+        default='locmem', help='cache backend: locmem (default) or file')
+    parser.add_option('-n', '--iterations', type='int', default=200,
+        help='renderings per benchmark (default: 200)')
+    parser.add_option('-o', '--output', help='write the JSON results to '
+        'this file instead of stdout')
+    parser.add_option('--compare', metavar='FILE', help='compare the '
+        'results with those of an earlier run')
+    parser.add_option('-l', '--list', action='store_true',
+        help='list the benchmarks and exit')
+    return parser.parse_args(argv)
+
+
+def configure(cache_backend):
+    """
+    Adapts the test project settings for benchmarking; has to happen before
+    flatblocks (which reads the cache at import time) is imported.
+    """
+    from django.conf import settings
+    settings.DEBUG = False
+    settings.TEMPLATE_DEBUG = False
+    cache_dir = None
+    if cache_backend == 'file':
+        cache_dir = tempfile.mkdtemp(prefix='flatblocks-benchmarks-')
+        settings.CACHES = {'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': cache_dir,
+        }}
+    else:
+        settings.CACHES = {'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }}
+    # The project logs at DEBUG level, which would dominate the timings
+    for name in ('flatblocks', 'south'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    return cache_dir
+
+
+def setup_database():
+    from django.db import connection
+    from south.management.commands import patch_for_test_db_setup
+    patch_for_test_db_setup()
+    connection.creation.create_test_db(verbosity=0)
+
+    from django.contrib.sites.models import Site
+    from flatblocks.models import FlatBlock
+    site = Site.objects.get_current()
+    FlatBlock.objects.bulk_create([
+        FlatBlock(slug='block-%d' % i, header='Header %d' % i,
+                  content='Content of block %d' % i, site=site)
+        for i in range(100)])
+
+
+class Benchmark(object):
+    def __init__(self, name, source, context=None):
+        self.name = name
+        self.source = '{% load flatblock_tags %}' + source
+        self.context = context or {}
+
+    def run(self, iterations, cold):
+        from django import template
+        from django.core.cache import cache
+        tpl = template.Template(self.source)
+        timer = timeit.default_timer
+        timings = []
+        cache.clear()
+        if not cold:
+            tpl.render(template.Context(self.context))
+        for i in range(iterations):
+            if cold:
+                cache.clear()
+            context = template.Context(self.context)
+            started = timer()
+            tpl.render(context)
+            timings.append(timer() - started)
+        return timings
+
+
+def page(tag, count):
+    return ''.join('{%% %s "block-%d" 60 %%}' % (tag, i)
+                   for i in range(count))
+
+
+def get_benchmarks():
+    benchmarks = []
+    for tag in ('flatblock', 'plain_flatblock'):
+        benchmarks.extend([
+            Benchmark('%s/static' % tag, '{%% %s "block-0" 60 %%}' % tag),
+            Benchmark('%s/variable' % tag, '{%% %s slug 60 %%}' % tag,
+                      {'slug': 'block-0'}),
+            Benchmark('%s/with-default' % tag, '{%% %s "block-0" 60 '
+                      'with-default "Header" %%}Default content'
+                      '{%% end_%s %%}' % (tag, tag)),
+            Benchmark('%s/with-default-missing' % tag, '{%% %s "missing" 60 '
+                      'with-default "Header" %%}Default content'
+                      '{%% end_%s %%}' % (tag, tag)),
+        ])
+    benchmarks.extend([
+        Benchmark('flatblock/using', '{% flatblock "block-0" 60 using '
+                  '"flatblocks/flatblock.html" %}'),
+        Benchmark('flatblock/using-only', '{% flatblock "block-0" 60 using '
+                  '"flatblocks/flatblock.html" only %}'),
+        Benchmark('flatblock/using-variable', '{% flatblock "block-0" 60 '
+                  'using tpl %}', {'tpl': 'flatblocks/flatblock.html'}),
+    ])
+    for count in (1, 10, 100):
+        for tag in ('flatblock', 'plain_flatblock'):
+            benchmarks.append(Benchmark('%s/page-%d' % (tag, count),
+                                        page(tag, count)))
+    return benchmarks
+
+
+def percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize(name, timings):
+    values = sorted(timings)
+    total = sum(values)
+    return {
+        'name': name,
+        'iterations': len(values),
+        'ops_per_sec': len(values) / total if total else None,
+        'mean_ms': total / len(values) * 1000,
+        'median_ms': percentile(values, 0.5) * 1000,
+        'p95_ms': percentile(values, 0.95) * 1000,
+        'min_ms': values[0] * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+
+def get_commit():
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        output = process.communicate()[0].strip()
+    except OSError:
+        return None
+    return process.returncode == 0 and output or None
+
+
+def compare(results, path):
+    f = open(path)
+    try:
+        previous = dict((result['name'], result)
+                        for result in json.load(f)['results'])
+    finally:
+        f.close()
+    for result in results:
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        change = (result['median_ms'] / before['median_ms'] - 1) * 100
+        sys.stderr.write('%-40s %9.3f ms -> %9.3f ms  %+6.1f%%\n' % (
+            result['name'], before['median_ms'], result['median_ms'],
+            change))
+
+
+def main(argv):
+    options, names = get_options(argv)
+    benchmarks = get_benchmarks()
+    if names:
+        benchmarks = [benchmark for benchmark in benchmarks
+                      if [name for name in names
+                          if benchmark.name.startswith(name)]]
+    if options.list:
+        for benchmark in benchmarks:
+            print(benchmark.name)
+        return 0
+    cache_dir = configure(options.cache)
+    try:
+        setup_database()
+        results = []
+        for benchmark in benchmarks:
+            for mode in ('cold', 'warm'):
+                name = '%s/%s' % (benchmark.name, mode)
+                result = summarize(name, benchmark.run(options.iterations,
+                                                       mode == 'cold'))
+                results.append(result)
+                sys.stderr.write('%-40s %9.0f ops/s  median %8.3f ms  '
+                                 'p95 %8.3f ms\n' % (name,
+                                 result['ops_per_sec'] or 0,
+                                 result['median_ms'], result['p95_ms']))
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    import django
+    from django.conf import settings
+    data = {
+        'meta': {
+            'commit': get_commit(),
+            'created': time.time(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'cache': settings.CACHES['default']['BACKEND'],
+            'database': 'sqlite3 (in memory)',
+            'iterations': options.iterations,
+        },
+        'results': results,
+    }
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(data, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    else:
+        json.dump(data, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if options.compare:
+        compare(results, options.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))